@@ -0,0 +1,7 @@
+import sqlite3
+
+
+def upgrade(conn: sqlite3.Connection):
+    db_cursor = conn.cursor()
+    # Only banned users are listed, so index just those rows
+    db_cursor.execute("CREATE INDEX IF NOT EXISTS idx_topics_banned ON topics(user_id) WHERE ban = 1")
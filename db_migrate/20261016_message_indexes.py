@@ -0,0 +1,9 @@
+import sqlite3
+
+
+def upgrade(conn: sqlite3.Connection):
+    db_cursor = conn.cursor()
+    db_cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_received ON messages(received_id, in_group)")
+    db_cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_forwarded ON messages(forwarded_id, in_group)")
+    db_cursor.execute("CREATE INDEX IF NOT EXISTS idx_messages_topic ON messages(topic_id)")
+    db_cursor.execute("CREATE INDEX IF NOT EXISTS idx_verified_user_id ON verified_users(user_id)")
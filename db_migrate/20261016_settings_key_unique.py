@@ -0,0 +1,8 @@
+import sqlite3
+
+
+def upgrade(conn: sqlite3.Connection):
+    db_cursor = conn.cursor()
+    # Drop duplicated keys before the unique index is created, keeping the oldest row
+    db_cursor.execute("DELETE FROM settings WHERE id NOT IN (SELECT MIN(id) FROM settings GROUP BY key)")
+    db_cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_settings_key ON settings(key)")
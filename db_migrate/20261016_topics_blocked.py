@@ -0,0 +1,7 @@
+import sqlite3
+
+
+def upgrade(conn: sqlite3.Connection):
+    db_cursor = conn.cursor()
+    # Set when Telegram refuses delivery to the user, e.g. because they blocked the bot
+    db_cursor.execute("ALTER TABLE topics ADD COLUMN blocked_at INTEGER")
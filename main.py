@@ -1,1255 +1,1634 @@
-import argparse
-import gettext
-import importlib
-import json
-import logging
-import os
-import queue
-import random
-import re
-import signal
-import sqlite3
-import threading
-from traceback import print_exc
-
-from diskcache import Cache
-from telebot import types, TeleBot
-from telebot.apihelper import create_forum_topic, close_forum_topic, ApiTelegramException, delete_forum_topic, \
-    reopen_forum_topic
-from telebot.types import Message, MessageReactionUpdated
-
-parser = argparse.ArgumentParser(description="")
-parser.add_argument("-token", type=str, required=True, help="Telegram bot token")
-parser.add_argument("-group_id", type=str, required=True, help="Group ID")
-parser.add_argument("-language", type=str, default="en_US", help="Language", choices=["en_US", "zh_CN", "ja_JP"])
-args = parser.parse_args()
-
-logger = logging.getLogger()
-logger.setLevel("INFO")
-BASIC_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
-DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
-formatter = logging.Formatter(BASIC_FORMAT, DATE_FORMAT)
-chlr = logging.StreamHandler()
-chlr.setFormatter(formatter)
-logger.addHandler(chlr)
-
-project_root = os.path.dirname(os.path.abspath(__file__))
-locale_dir = os.path.join(project_root, "locale")
-gettext.bindtextdomain("BetterForward", locale_dir)
-gettext.textdomain("BetterForward")
-try:
-    _ = gettext.translation("BetterForward", locale_dir, languages=[args.language]).gettext
-except FileNotFoundError:
-    _ = gettext.gettext
-
-stop = False
-
-
-def handle_sigterm(*args):
-    global stop
-    stop = True
-    raise KeyboardInterrupt()
-
-
-def escape_markdown(text):
-    escape_chars = r'\*_`\[\]()'
-    return re.sub(f'([{escape_chars}])', r'\\\1', text)
-
-
-signal.signal(signal.SIGTERM, handle_sigterm)
-signal.signal(signal.SIGINT, handle_sigterm)
-
-
-class TGBot:
-    def __init__(self, bot_token: str, group_id: str, db_path: str = "./data/storage.db"):
-        logger.info(_("Starting BetterForward..."))
-        self.group_id = int(group_id)
-        self.bot = TeleBot(token=bot_token)
-        self.bot.edited_message_handler(func=lambda m: True)(self.handle_edit)
-        self.bot.message_handler(commands=["start", "help"])(self.help)
-        self.bot.message_handler(commands=["ban"])(self.ban_user)
-        self.bot.message_handler(commands=["unban"])(self.unban_user)
-        self.bot.message_handler(commands=["terminate"])(self.handle_terminate)
-        self.bot.message_handler(commands=["delete"])(self.delete_message)
-        self.bot.message_handler(commands=["verify"])(self.handle_verify)
-        self.bot.message_handler(func=lambda m: True, content_types=["photo", "text", "sticker", "video", "document"])(
-            self.push_messages)
-        self.bot.message_reaction_handler(func=lambda message: True)(self.handle_reaction)
-        self.bot.callback_query_handler(func=lambda call: True)(self.callback_query)
-        self.db_path = db_path
-        # Check path exists
-        if not os.path.exists(os.path.dirname(db_path)):
-            os.makedirs(os.path.dirname(db_path))
-        self.upgrade_db()
-        self.bot.set_my_commands([
-            types.BotCommand("delete", _("Delete a message")),
-            types.BotCommand("help", _("Show help")),
-        ], scope=types.BotCommandScopeAllPrivateChats())
-        self.bot.set_my_commands([
-            types.BotCommand("help", _("Show help")),
-            types.BotCommand("ban", _("Ban a user")),
-            types.BotCommand("unban", _("Unban a user")),
-            types.BotCommand("delete", _("Delete a message")),
-            types.BotCommand("terminate", _("Terminate a thread")),
-            types.BotCommand("verify", _("Set verified status")),
-        ], scope=types.BotCommandScopeChat(self.group_id))
-        self.cache = Cache()
-        self.load_settings()
-        self.check_permission()
-        self.message_queue = queue.Queue()
-        self.message_processor = threading.Thread(target=self.process_messages)
-        self.message_processor.start()
-        self.bot.infinity_polling(skip_pending=True, timeout=30,
-                                  allowed_updates=['message', 'edited_message', 'callback_query', 'my_chat_member',
-                                                   'message_reaction', 'message_reaction_count', ])
-
-    def check_valid_chat(self, message: Message):
-        return message.chat.id == self.group_id and message.message_thread_id is None
-
-    def upgrade_db(self):
-        try:
-            with sqlite3.connect(self.db_path) as db:
-                db_cursor = db.cursor()
-                db_cursor.execute("SELECT value FROM settings WHERE key = 'db_version'")
-                current_version = int(db_cursor.fetchone()[0])
-        except sqlite3.OperationalError:
-            current_version = 0
-        db_migrate_dir = "./db_migrate"
-        files = [f for f in os.listdir(db_migrate_dir) if f.endswith('.py')]
-        files.sort(key=lambda x: int(x.split('_')[0]))
-        for file in files:
-            try:
-                if (version := int(file.split('_')[0])) > current_version:
-                    logger.info(_("Upgrading database to version {}").format(version))
-                    module = importlib.import_module(f"db_migrate.{file[:-3]}")
-                    module.upgrade(self.db_path)
-                    with sqlite3.connect(self.db_path) as db:
-                        db_cursor = db.cursor()
-                        db_cursor.execute("UPDATE settings SET value = ? WHERE key = 'db_version'", (str(version),))
-                        db.commit()
-            except Exception:
-                logger.error(_("Failed to upgrade database"))
-                print_exc()
-                exit(1)
-
-    def load_settings(self):
-        # Load settings
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("SELECT key, value FROM settings")
-            for key, value in db_cursor.fetchall():
-                self.cache.set(f"setting_{key}", value)
-
-    def generate_captcha(self, user_id: int, type="math"):
-        match type:
-            case "math":
-                num1 = random.randint(1, 10)
-                num2 = random.randint(1, 10)
-                answer = num1 + num2
-                self.cache.set(f"captcha_{user_id}", answer, 300)
-                return f"{num1} + {num2} = ?"
-            case "button":
-                markup = types.InlineKeyboardMarkup()
-                markup.add(types.InlineKeyboardButton("Click to verify", callback_data=json.dumps(
-                    {"action": "verify_button", "user_id": user_id})))
-                self.bot.send_message(user_id, _("Please click the button to verify."), reply_markup=markup)
-            case _:
-                raise ValueError(_("Invalid captcha setting"))
-
-    def handle_button_captcha(self, call: types.CallbackQuery):
-        data = json.loads(call.data)
-        if data.get("action") == "verify_button":
-            user_id = data.get("user_id")
-            if user_id:
-                self.cache.set(f"verified_{user_id}", True, 1800)  # 设置用户为已验证
-                self.bot.answer_callback_query(call.id)
-                self.bot.send_message(user_id, _("Verification successful, you can now send messages"))
-                self.bot.delete_message(call.message.chat.id, call.message.message_id)
-                with sqlite3.connect(self.db_path) as db:
-                    db_cursor = db.cursor()
-                    db_cursor.execute("INSERT INTO verified_users (user_id) VALUES (?)", (user_id,))
-                    db.commit()
-                self.cache.set(f"verified_{user_id}", True, 1800)
-            else:
-                self.bot.answer_callback_query(call.id)
-                self.bot.send_message(call.message.chat.id, _("Invalid user ID"))
-
-    # Get thread_id to terminate when needed
-    def terminate_thread(self, thread_id=None, user_id=None):
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            if thread_id is not None:
-                result = db_cursor.execute("SELECT user_id FROM topics WHERE thread_id = ? LIMIT 1", (thread_id,))
-                if (user_id := result.fetchone()) is not None:
-                    user_id = user_id[0]
-                    db_cursor.execute("DELETE FROM topics WHERE thread_id = ?", (thread_id,))
-                    db.commit()
-            elif user_id is not None:
-                result = db_cursor.execute("SELECT thread_id FROM topics WHERE user_id = ? LIMIT 1", (user_id,))
-                if (thread_id := result.fetchone()[0]) is not None:
-                    db_cursor.execute("DELETE FROM topics WHERE user_id = ?", (user_id,))
-                    db.commit()
-            self.cache.delete(f"chat_{user_id}_threadid")
-            self.cache.delete(f"threadid_{thread_id}_userid")
-            try:
-                delete_forum_topic(chat_id=self.group_id, message_thread_id=thread_id, token=self.bot.token)
-            except ApiTelegramException:
-                pass
-            db_cursor.execute("DELETE FROM messages WHERE topic_id = ?", (thread_id,))
-        logger.info(_("Terminating thread") + str(thread_id))
-
-    # To terminate and totally delete the topic
-    def handle_terminate(self, message: Message):
-        if message.chat.id == self.group_id:
-            user_id = None
-            thread_id = None
-            if message.message_thread_id is None:
-                if len((msg_split := message.text.split(" "))) != 2:
-                    self.bot.reply_to(message, "Invalid command\n"
-                                               "Correct usage:```\n"
-                                               "/terminate <user ID>```", parse_mode="Markdown")
-                    return
-                user_id = int(msg_split[1])
-            else:
-                thread_id = message.message_thread_id
-            if thread_id == 1:
-                self.bot.reply_to(message, _("Cannot terminate main thread"))
-                return
-            try:
-                self.terminate_thread(thread_id=thread_id, user_id=user_id)
-                if message.message_thread_id is None:
-                    self.bot.reply_to(message, _("Thread terminated"))
-            except Exception:
-                logger.error(_("Failed to terminate the thread") + str(thread_id))
-                self.bot.reply_to(message, _("Failed to terminate the thread"))
-        else:
-            self.bot.send_message(message.chat.id, _("This command is only available to admin users."))
-
-    def match_auto_response(self, text):
-        if text is None:
-            return None
-        with sqlite3.connect(self.db_path) as db:
-            # Check for exact match
-            db_cursor = db.cursor()
-            db_cursor.execute(
-                "SELECT value, topic_action, type FROM auto_response WHERE key = ? AND is_regex = 0 LIMIT 1",
-                (text,))
-            result = db_cursor.fetchone()
-            if result is not None:
-                return {"response": result[0], "topic_action": result[1], "type": result[2]}
-
-            # Check for regex
-            db_cursor.execute("SELECT key, value, topic_action, type FROM auto_response WHERE is_regex = 1")
-            result = db_cursor.fetchall()
-            for row in result:
-                try:
-                    if re.match(row[0], text):
-                        return {"response": row[1], "topic_action": row[2], "type": row[3]}
-                except re.error:
-                    logger.error(_("Invalid regular expression: {}").format(row[0]))
-                    return None
-            return None
-
-    # Push messages to the queue
-    def push_messages(self, message: Message):
-        self.message_queue.put(message)
-
-    # Main message handler
-    def handle_message(self, message: Message, retry=False):
-        # Not responding in General topic
-        if self.check_valid_chat(message):
-            return
-        with sqlite3.connect(self.db_path) as db:
-            curser = db.cursor()
-            if message.chat.id != self.group_id:
-                logger.info(
-                    _("Received message from {}, content: {}, type: {}").format(message.from_user.id, message.text,
-                                                                                message.content_type))
-                if self.cache.get("setting_captcha") != "disable":
-                    # Captcha Handler
-                    if (captcha := self.cache.get(f"captcha_{message.from_user.id}")) is not None:
-                        if message.text != str(captcha):
-                            logger.info(_("User {} entered an incorrect answer").format(message.from_user.id))
-                            self.bot.send_message(message.chat.id, _("The answer is incorrect, please try again"))
-                            return
-                        logger.info(_("User {} passed the captcha").format(message.from_user.id))
-                        self.bot.send_message(message.chat.id, _("Verification successful, you can now send messages"))
-                        curser.execute("INSERT INTO verified_users (user_id) VALUES (?)",
-                                       (message.from_user.id,))
-                        self.cache.delete(f"captcha_{message.from_user.id}")
-                        self.cache.set(f"verified_{message.from_user.id}", True, 1800)
-                        return
-
-                    # Check if the user is verified
-                    verified = self.cache.get(f"verified_{message.from_user.id}")
-                    if verified is None:
-                        result = curser.execute("SELECT 1 FROM verified_users WHERE user_id = ? LIMIT 1",
-                                                (message.from_user.id,))
-                        if result.fetchone() is not None:
-                            verified = True
-                        else:
-                            verified = False
-
-                    if not verified:
-                        logger.info(_("User {} is not verified").format(message.from_user.id))
-                        match self.cache.get("setting_captcha"):
-                            case "button":
-                                self.generate_captcha(message.from_user.id, self.cache.get("setting_captcha"))
-                                return
-                            case "math":
-                                captcha = self.generate_captcha(message.from_user.id, self.cache.get("setting_captcha"))
-                                self.bot.send_message(message.chat.id,
-                                                      _("Captcha is enabled. Please solve the following question and send the result directly\n") + captcha)
-                                return
-                            case _:
-                                logger.error(_("Invalid captcha setting"))
-                                self.bot.send_message(self.group_id,
-                                                      _("Invalid captcha setting") + f": {self.cache.get('setting_captcha')}")
-                                return
-                    else:
-                        self.cache.set(f"verified_{message.from_user.id}", verified, 1800)
-
-                # Check if the user is banned
-                if (result := curser.execute("SELECT ban FROM topics WHERE user_id = ? LIMIT 1",
-                                             (message.from_user.id,)).fetchone()) and result[0] == 1:
-                    logger.info(_("User {} is banned").format(message.from_user.id))
-                    return
-                # Auto response
-                topic_action = False
-                auto_response = None
-                if (auto_response_result := self.match_auto_response(message.text)) is not None:
-                    if not retry:
-                        match auto_response_result["type"]:
-                            case "text":
-                                self.bot.send_message(message.chat.id,
-                                                      auto_response_result["response"])
-                            case "photo":
-                                self.bot.send_photo(message.chat.id,
-                                                    photo=auto_response_result["response"])
-                            case "sticker":
-                                self.bot.send_sticker(message.chat.id,
-                                                      sticker=auto_response_result["response"])
-                            case "video":
-                                self.bot.send_video(message.chat.id,
-                                                    video=auto_response_result["response"])
-                            case "document":
-                                self.bot.send_document(message.chat.id,
-                                                       document=auto_response_result["response"])
-                            case _:
-                                logger.error(_("Unsupported message type") + auto_response_result["type"])
-                    if auto_response_result["topic_action"]:
-                        topic_action = True
-                        auto_response = auto_response_result["response"]
-                    else:
-                        return
-                # Forward message to group
-                userid = message.from_user.id
-                if (thread_id := self.cache.get(f"chat_{userid}_threadid")) is None:
-                    result = curser.execute("SELECT thread_id FROM topics WHERE user_id = ? LIMIT 1", (userid,))
-                    thread_id = result.fetchone()
-                    if thread_id is None:
-                        # Create a new thread
-                        logger.info(_("Creating a new thread for user {}").format(userid))
-                        try:
-                            topic = create_forum_topic(chat_id=self.group_id, name=message.from_user.first_name,
-                                                       token=self.bot.token)
-                        except Exception as e:
-                            logger.error(e)
-                            return
-                        curser.execute("INSERT INTO topics (user_id, thread_id) VALUES (?, ?)",
-                                       (userid, topic["message_thread_id"]))
-                        db.commit()
-                        thread_id = topic["message_thread_id"]
-                        username = _(
-                            "Not set") if message.from_user.username is None else f"@{message.from_user.username}"
-                        last_name = "" if message.from_user.last_name is None else f" {message.from_user.last_name}"
-                        pin_message = self.bot.send_message(self.group_id,
-                                                            f"User ID: [{userid}](tg://openmessage?user_id={userid})\n"
-                                                            f"Full Name: {escape_markdown(f"{message.from_user.first_name}{last_name}")}\n"
-                                                            f"Username: {escape_markdown(username)}\n",
-                                                            message_thread_id=thread_id, parse_mode='markdown')
-                        self.bot.pin_chat_message(self.group_id, pin_message.message_id)
-                    else:
-                        thread_id = thread_id[0]
-                    self.cache.set(f"chat_{userid}_threadid", thread_id)
-                try:
-                    reply_id = None
-                    if message.reply_to_message is not None:
-                        if message.reply_to_message.from_user.id == message.from_user.id:
-                            curser.execute(
-                                "SELECT forwarded_id FROM messages WHERE received_id = ? AND topic_id = ? AND in_group = ? LIMIT 1",
-                                (message.reply_to_message.message_id, thread_id, False,))
-                        else:
-                            curser.execute(
-                                "SELECT received_id FROM messages WHERE forwarded_id = ? AND topic_id = ? AND in_group = ? LIMIT 1",
-                                (message.reply_to_message.message_id, thread_id, True,))
-                        if (result := curser.fetchone()) is not None:
-                            reply_id = int(result[0])
-                    match message.content_type:
-                        case "photo":
-                            fwd_msg = self.bot.send_photo(chat_id=self.group_id,
-                                                          photo=message.photo[-1].file_id,
-                                                          caption=message.caption,
-                                                          message_thread_id=thread_id,
-                                                          reply_to_message_id=reply_id)
-                        case "text":
-                            fwd_msg = self.bot.send_message(chat_id=self.group_id,
-                                                            text=message.text,
-                                                            message_thread_id=thread_id,
-                                                            reply_to_message_id=reply_id)
-                        case "sticker":
-                            fwd_msg = self.bot.send_sticker(chat_id=self.group_id,
-                                                            sticker=message.sticker.file_id,
-                                                            message_thread_id=thread_id,
-                                                            reply_to_message_id=reply_id)
-                        case "video":
-                            fwd_msg = self.bot.send_video(chat_id=self.group_id,
-                                                          video=message.video.file_id,
-                                                          caption=message.caption,
-                                                          message_thread_id=thread_id,
-                                                          reply_to_message_id=reply_id)
-                        case "document":
-                            fwd_msg = self.bot.send_document(chat_id=self.group_id,
-                                                             document=message.document.file_id,
-                                                             caption=message.caption,
-                                                             message_thread_id=thread_id,
-                                                             reply_to_message_id=reply_id)
-                        case _:
-                            logger.error(_("Unsupported message type") + message.content_type)
-                            return
-                    curser.execute(
-                        "INSERT INTO messages (received_id, forwarded_id, topic_id, in_group) VALUES (?, ?, ?, ?)",
-                        (message.message_id, fwd_msg.message_id, thread_id, False,))
-                except ApiTelegramException as e:
-                    if not retry:
-                        self.terminate_thread(thread_id=thread_id)
-                        return self.handle_message(message, retry=True)
-                    else:
-                        logger.error(_("Failed to forward message from user {}".format(message.from_user.id)))
-                        logger.error(e)
-                        self.bot.send_message(self.group_id,
-                                              _("Failed to forward message from user {}".format(message.from_user.id)),
-                                              message_thread_id=None)
-                        self.bot.forward_message(self.group_id, message.chat.id, message_id=message.message_id)
-                        return
-                if topic_action:
-                    self.bot.send_message(self.group_id, _("[Auto Response]") + auto_response,
-                                          message_thread_id=thread_id)
-            else:
-                # Forward message to user
-                if (user_id := self.cache.get(f"threadid_{message.message_thread_id}_userid")) is None:
-                    result = curser.execute("SELECT user_id FROM topics WHERE thread_id = ? LIMIT 1",
-                                            (message.message_thread_id,))
-                    user_id = result.fetchone()[0]
-                    self.cache.set(f"threadid_{message.message_thread_id}_userid", user_id)
-                if user_id is not None:
-                    reply_id = None
-                    if message.reply_to_message is not None:
-                        if message.reply_to_message.from_user.id == message.from_user.id:
-                            curser.execute(
-                                "SELECT forwarded_id FROM messages WHERE received_id = ? AND topic_id = ? AND in_group = ? LIMIT 1",
-                                (message.reply_to_message.message_id, message.message_thread_id, True,))
-                        else:
-                            curser.execute(
-                                "SELECT received_id FROM messages WHERE forwarded_id = ? AND topic_id = ? AND in_group = ? LIMIT 1",
-                                (message.reply_to_message.message_id, message.message_thread_id, False,))
-                        if (result := curser.fetchone()) is not None:
-                            reply_id = int(result[0])
-                    match message.content_type:
-                        case "photo":
-                            fwd_msg = self.bot.send_photo(chat_id=user_id,
-                                                          photo=message.photo[-1].file_id,
-                                                          caption=message.caption,
-                                                          reply_to_message_id=reply_id)
-                        case "text":
-                            fwd_msg = self.bot.send_message(chat_id=user_id,
-                                                            text=message.text,
-                                                            reply_to_message_id=reply_id)
-                        case "sticker":
-                            fwd_msg = self.bot.send_sticker(chat_id=user_id,
-                                                            sticker=message.sticker.file_id,
-                                                            reply_to_message_id=reply_id)
-                        case "video":
-                            fwd_msg = self.bot.send_video(chat_id=user_id,
-                                                          video=message.video.file_id,
-                                                          caption=message.caption,
-                                                          reply_to_message_id=reply_id)
-                        case "document":
-                            fwd_msg = self.bot.send_document(chat_id=user_id,
-                                                             document=message.document.file_id,
-                                                             caption=message.caption,
-                                                             reply_to_message_id=reply_id)
-                        case _:
-                            logger.error(_("Unsupported message type") + message.content_type)
-                            return
-                    curser.execute(
-                        "INSERT INTO messages (received_id, forwarded_id, topic_id, in_group) VALUES (?, ?, ?, ?)",
-                        (message.message_id, fwd_msg.message_id, message.message_thread_id, True,))
-                else:
-                    self.bot.send_message(self.group_id, _("Chat not found, please remove this topic manually"),
-                                          message_thread_id=message.message_thread_id)
-                    close_forum_topic(chat_id=self.group_id, message_thread_id=message.message_thread_id,
-                                      token=self.bot.token)
-
-    # Process messages in the queue
-    def process_messages(self):
-        while stop is False:
-            try:
-                message = self.message_queue.get(timeout=1)
-                self.handle_message(message)
-            except queue.Empty:
-                continue  # Skip to the next iteration if the queue is empty
-            except Exception as e:
-                logger.error(_("Failed to process message: {}").format(e))
-        self.bot.stop_bot()
-
-    def check_permission(self):
-        if not self.bot.get_chat(self.group_id).is_forum:
-            logger.error(_("Topic function is not enabled in this group"))
-            self.bot.send_message(self.group_id, _("Topic function is not enabled in this group"))
-        chat_member = self.bot.get_chat_member(self.group_id, self.bot.get_me().id)
-        permissions = {
-            _("Manage Topics"): chat_member.can_manage_topics,
-            _("Delete Messages"): chat_member.can_delete_messages
-        }
-        for key, value in permissions.items():
-            if value is False:
-                logger.error(_("Bot doesn't have {} permission").format(key))
-                self.bot.send_message(self.group_id, _("Bot doesn't have {} permission").format(key))
-        self.bot.send_message(self.group_id, _("Bot started successfully"))
-
-    def add_auto_response(self, message: Message):
-        if not self.check_valid_chat(message):
-            return
-        msg = self.bot.edit_message_text(text=_(
-            "Let's set up an automatic response.\nSend /cancel to cancel this operation.\n\n"
-            "Please send the keywords or regular expression that should trigger this response."),
-            chat_id=self.group_id, message_id=message.message_id)
-        self.bot.register_next_step_handler(msg, self.add_auto_response_type)
-
-    def add_auto_response_type(self, message: Message):
-        # 选择是否是正则表达式
-        if not self.check_valid_chat(message):
-            return
-        if isinstance(message.text, str) and message.text == "/cancel":
-            self.bot.send_message(self.group_id, _("Operation cancelled"))
-            return
-        if message.content_type != "text":
-            self.bot.send_message(self.group_id, _("Invalid input"))
-            return
-        self.cache.set("auto_response_key", message.text, 300)
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("✅" + _("Yes"),
-                                              callback_data=json.dumps(
-                                                  {"action": "set_auto_reply_type", "regex": True})))
-        markup.add(types.InlineKeyboardButton("❌" + _("No"),
-                                              callback_data=json.dumps(
-                                                  {"action": "set_auto_reply_type", "regex": False})))
-        markup.add(
-            types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "auto_reply"})))
-        help_text = _("Trigger: {}").format(self.cache.get("auto_response_key")) + "\n\n"
-        help_text += _("Is this a regular expression?")
-        self.bot.send_message(text=help_text, chat_id=self.group_id, reply_markup=markup)
-
-    def add_auto_response_value(self, message: Message):
-        if not self.check_valid_chat(message):
-            return
-        if isinstance(message.text, str) and message.text == "/cancel":
-            self.bot.send_message(self.group_id, _("Operation cancelled"))
-            return
-        if self.cache.get("auto_response_regex") is True:
-            try:
-                re.compile(message.text)
-            except re.error:
-                markup = types.InlineKeyboardMarkup()
-                markup.add(types.InlineKeyboardButton("⬅️" + _("Back"),
-                                                      callback_data=json.dumps({"action": "auto_reply"})))
-                self.bot.edit_message_text(text=_("Invalid regular expression"), chat_id=self.group_id,
-                                           message_id=message.message_id, reply_markup=markup)
-                return
-        msg = self.bot.edit_message_text(text=_("Please send the response content. It can be text, stickers, photos "
-                                                "and so on."),
-                                         chat_id=self.group_id, message_id=message.message_id)
-        self.bot.register_next_step_handler(msg, self.add_auto_response_topic_action)
-
-    def add_auto_response_topic_action(self, message: Message):
-        if not self.check_valid_chat(message):
-            return
-        if isinstance(message.text, str) and message.text == "/cancel":
-            self.bot.send_message(self.group_id, _("Operation cancelled"))
-            self.cache.delete("auto_response_key")
-            return
-        if self.cache.get("auto_response_key") is None:
-            self.bot.send_message(self.group_id, _("The operation has timed out. Please initiate the process again."))
-            return
-        self.cache.set("auto_response_key", self.cache.get("auto_response_key"), 300)
-        match message.content_type:
-            case "photo":
-                self.cache.set("auto_response_value", message.photo[-1].file_id, 300)
-                self.cache.set("auto_response_type", "photo", 300)
-            case "text":
-                self.cache.set("auto_response_value", message.text, 300)
-                self.cache.set("auto_response_type", "text", 300)
-            case "sticker":
-                self.cache.set("auto_response_value", message.sticker.file_id, 300)
-                self.cache.set("auto_response_type", "sticker", 300)
-            case "video":
-                self.cache.set("auto_response_value", message.video.file_id, 300)
-                self.cache.set("auto_response_type", "video", 300)
-            case "document":
-                self.cache.set("auto_response_value", message.document.file_id, 300)
-                self.cache.set("auto_response_type", "document", 300)
-            case _:
-                self.bot.send_message(self.group_id, _("Unsupported message type"))
-                return
-        self.cache.set("auto_response_regex", self.cache.get("auto_response_regex"), 300)
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("✅" + _("Forward message"),
-                                              callback_data=json.dumps(
-                                                  {"action": "add_auto_reply", "topic_action": True})))
-        markup.add(types.InlineKeyboardButton("❌" + _("Do not forward message"),
-                                              callback_data=json.dumps(
-                                                  {"action": "add_auto_reply", "topic_action": False})))
-        markup.add(
-            types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "add_auto_reply"})))
-        help_text = ""
-        help_text += _("Trigger: {}").format(self.cache.get("auto_response_key")) + "\n"
-        help_text += _("Response: {}").format(
-            self.cache.get("auto_response_value") if self.cache.get("auto_response_type") == "text" else self.cache.get(
-                "auto_response_type")) + "\n"
-        help_text += _("Is regex: {}").format("✅" if self.cache.get("auto_response_regex") else "❌") + "\n\n"
-        self.bot.send_message(self.group_id, help_text + _("Do you want to forward the message to the user?"),
-                              reply_markup=markup,
-                              message_thread_id=None)
-
-    def process_add_auto_reply(self, message: Message, data: dict):
-        key = self.cache.pop("auto_response_key")
-        value = self.cache.pop("auto_response_value")
-        is_regex = self.cache.pop("auto_response_regex")
-        type = self.cache.pop("auto_response_type")
-        markup = types.InlineKeyboardMarkup()
-        back_button = types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "menu"}))
-        if "topic_action" not in data or None in [key, value, is_regex, type]:
-            self.bot.delete_message(self.group_id, message.id)
-            self.bot.send_message(self.group_id, _("Invalid action"), reply_markup=markup)
-            return
-        topic_action = data["topic_action"]
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute(
-                "INSERT INTO auto_response (key, value, topic_action, is_regex, type) VALUES (?, ?, ?, ?, ?)",
-                (key, value, topic_action, is_regex, type))
-            db.commit()
-        markup.add(back_button)
-        self.bot.edit_message_text(_("Auto reply added"), message.chat.id, message.message_id, reply_markup=markup)
-
-    def menu(self, message, edit=False):
-        if not self.check_valid_chat(message):
-            return
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("💬" + _("Auto Reply"),
-                                              callback_data=json.dumps({"action": "auto_reply"})))
-        markup.add(types.InlineKeyboardButton("📙" + _("Default Message"),
-                                              callback_data=json.dumps({"action": "default_msg"})))
-        markup.add(types.InlineKeyboardButton("⛔" + _("Banned Users"),
-                                              callback_data=json.dumps({"action": "ban_user"})))
-        markup.add(types.InlineKeyboardButton("🔒" + _("Captcha Settings"),
-                                              callback_data=json.dumps({"action": "captcha_settings"})))
-        markup.add(types.InlineKeyboardButton("📢" + _("Broadcast Message"),
-                                              callback_data=json.dumps({"action": "broadcast_message"})))
-        if edit:
-            self.bot.edit_message_text(_("Menu"), message.chat.id, message.message_id, reply_markup=markup)
-        else:
-            self.bot.send_message(self.group_id, _("Menu"), reply_markup=markup, message_thread_id=None)
-
-    def help(self, message: Message):
-        if self.check_valid_chat(message):
-            self.menu(message)
-        else:
-            if (response := self.get_setting('default_message')) is None:
-                self.bot.send_message(message.chat.id, _("I'm a bot that forwards messages, so please just tell me "
-                                                         "what you want to say.") + "\n" +
-                                      "Powered by [BetterForward](https://github.com/SideCloudGroup/BetterForward)",
-                                      parse_mode="Markdown",
-                                      disable_web_page_preview=True)
-            else:
-                self.bot.send_message(message.chat.id, response)
-
-    def get_setting(self, key):
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("SELECT value FROM settings WHERE key = ? LIMIT 1", (key,))
-            result = db_cursor.fetchone()
-            return result[0] if result else None
-
-    def manage_auto_reply(self, message: Message, page: int = 1, page_size: int = 5):
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            markup = types.InlineKeyboardMarkup()
-            back_button = types.InlineKeyboardButton("⬅️" + _("Back"),
-                                                     callback_data=json.dumps({"action": "auto_reply"}))
-
-            # Calculate pagination
-            offset = (page - 1) * page_size
-            db_cursor.execute("SELECT COUNT(*) FROM auto_response")
-            total_responses = db_cursor.fetchone()[0]
-            total_pages = (total_responses + page_size - 1) // page_size
-
-            # Fetch data with limits
-            db_cursor.execute("SELECT id, key, value, topic_action, is_regex, type FROM auto_response LIMIT ? OFFSET ?",
-                              (page_size, offset))
-            auto_responses = db_cursor.fetchall()
-
-            text = _("Auto Reply List:") + "\n" + _("Total: {}").format(total_responses) + "\n" + _("Page: {}").format(
-                page) + "/" + str(total_pages) + "\n\n"
-            id_buttons = []
-            for auto_response in auto_responses:
-                text += "-" * 20 + "\n"
-                text += f"ID: {auto_response[0]}\n"
-                text += _("Trigger: {}").format(auto_response[1]) + "\n"
-                text += _("Response: {}").format(
-                    auto_response[2] if auto_response[5] == "text" else auto_response[5]) + "\n"
-                text += _("Forward message: {}").format("✅" if auto_response[3] else "❌") + "\n"
-                text += _("Is regex: {}").format("✅" if auto_response[4] else "❌") + "\n\n"
-                id_buttons.append(types.InlineKeyboardButton(text=auto_response[0],
-                                                             callback_data=json.dumps({"action": "select_auto_reply",
-                                                                                       "id": auto_response[0]})))
-
-            # Add ID buttons in a single row
-            if id_buttons:
-                markup.row(*id_buttons)
-
-            # Add pagination buttons
-            if 1 < page < total_pages:
-                markup.row(
-                    types.InlineKeyboardButton("⬅️" + _("Previous Page"),
-                                               callback_data=json.dumps(
-                                                   {"action": "manage_auto_reply", "page": page - 1})),
-                    types.InlineKeyboardButton("➡️" + _("Next Page"),
-                                               callback_data=json.dumps(
-                                                   {"action": "manage_auto_reply", "page": page + 1}))
-                )
-            elif page > 1:
-                markup.add(types.InlineKeyboardButton("⬅️" + _("Previous Page"),
-                                                      callback_data=json.dumps(
-                                                          {"action": "manage_auto_reply", "page": page - 1})))
-            elif page < total_pages:
-                markup.add(types.InlineKeyboardButton("➡️" + _("Next Page"),
-                                                      callback_data=json.dumps(
-                                                          {"action": "manage_auto_reply", "page": page + 1})))
-
-            # Add back button in a separate row
-            markup.add(back_button)
-            self.bot.edit_message_text(text, message.chat.id, message.message_id, reply_markup=markup)
-
-    def select_auto_reply(self, message: Message, id: int):
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("SELECT key, value, topic_action, is_regex, type FROM auto_response WHERE id = ? LIMIT 1",
-                              (id,))
-            auto_response = db_cursor.fetchone()
-            if auto_response is None:
-                self.bot.send_message(self.group_id, _("Auto reply not found"))
-                return
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("❌" + _("Delete"),
-                                                  callback_data=json.dumps({"action": "delete_auto_reply", "id": id})))
-            markup.add(types.InlineKeyboardButton("⬅️" + _("Back"),
-                                                  callback_data=json.dumps({"action": "manage_auto_reply"})))
-            text = _("Trigger: {}").format(auto_response[0]) + "\n"
-            text += _("Response: {}").format(
-                auto_response[1] if auto_response[4] == "text" else auto_response[4]) + "\n"
-            text += _("Forward message: {}").format("✅" if auto_response[2] else "❌") + "\n"
-            text += _("Is regex: {}").format("✅" if auto_response[3] else "❌") + "\n\n"
-            self.bot.edit_message_text(text, message.chat.id, message.message_id, reply_markup=markup)
-
-    def delete_auto_reply(self, message: Message, id: int):
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("DELETE FROM auto_response WHERE id = ?", (id,))
-            db.commit()
-        markup = types.InlineKeyboardMarkup()
-        markup.add(
-            types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "manage_auto_reply"})))
-        self.bot.edit_message_text(_("Auto reply deleted"), chat_id=message.chat.id, message_id=message.id,
-                                   reply_markup=markup)
-
-    def ban_user(self, message: Message):
-        if message.chat.id == self.group_id and message.message_thread_id is None:
-            self.bot.send_message(self.group_id, _("This command is not available in the main chat."))
-            return
-        if message.chat.id != self.group_id:
-            self.bot.send_message(message.chat.id, _("This command is only available to admin users."))
-            return
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("UPDATE topics SET ban = 1 WHERE thread_id = ?", (message.message_thread_id,))
-            # Remove user from verified list
-            db_cursor.execute("DELETE FROM verified_users WHERE user_id = ?", (message.from_user.id,))
-            db.commit()
-        self.bot.send_message(self.group_id, _("User banned"), message_thread_id=message.message_thread_id)
-        close_forum_topic(chat_id=self.group_id, message_thread_id=message.message_thread_id, token=self.bot.token)
-
-    def unban_user(self, message: Message, user_id: int = None):
-        if message.chat.id != self.group_id:
-            self.bot.send_message(message.chat.id, _("This command is only available to admin users."))
-            return
-        if user_id is None:
-            if self.check_valid_chat(message):
-                if len((msg_split := message.text.split(" "))) != 2:
-                    self.bot.reply_to(message, "Invalid command\n"
-                                               "Correct usage:```\n"
-                                               "/unban <user ID>```", parse_mode="Markdown")
-                    return
-                user_id = int(msg_split[1])
-        if user_id is None:
-            with sqlite3.connect(self.db_path) as db:
-                db_cursor = db.cursor()
-                db_cursor.execute("UPDATE topics SET ban = 0 WHERE thread_id = ?", (message.message_thread_id,))
-                db.commit()
-            self.bot.send_message(self.group_id, _("User unbanned"), message_thread_id=message.message_thread_id)
-            try:
-                reopen_forum_topic(chat_id=self.group_id, message_thread_id=message.message_thread_id,
-                                   token=self.bot.token)
-            except ApiTelegramException:
-                pass
-        else:
-            with sqlite3.connect(self.db_path) as db:
-                db_cursor = db.cursor()
-                # Check user exists
-                db_cursor.execute("SELECT thread_id FROM topics WHERE user_id = ? LIMIT 1", (user_id,))
-                thread_id = db_cursor.fetchone()
-                if thread_id is None:
-                    self.bot.send_message(self.group_id, _("User not found"))
-                    return
-                db_cursor.execute("UPDATE topics SET ban = 0 WHERE user_id = ?", (user_id,))
-                db.commit()
-            try:
-                reopen_forum_topic(chat_id=self.group_id, message_thread_id=thread_id,
-                                   token=self.bot.token)
-            except ApiTelegramException:
-                pass
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "menu"})))
-            if message.from_user.id == self.bot.get_me().id:
-                self.bot.edit_message_text(_("User unbanned"), message.chat.id, message.message_id, reply_markup=markup)
-            else:
-                self.bot.send_message(self.group_id, _("User unbanned"), reply_markup=markup)
-
-    def manage_ban_user(self, message: Message):
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            markup = types.InlineKeyboardMarkup()
-            back_button = types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "menu"}))
-            db_cursor.execute("SELECT user_id FROM topics WHERE ban = 1")
-            banned_users = db_cursor.fetchall()
-            text = _("Banned User List:") + "\n"
-            for user in banned_users:
-                text += "-" * 20 + "\n"
-                text += f"User ID: {user[0]}\n"
-                markup.add(types.InlineKeyboardButton(text=user[0],
-                                                      callback_data=json.dumps(
-                                                          {"action": "select_ban_user", "id": user[0]})))
-            markup.add(back_button)
-            self.bot.edit_message_text(text, message.chat.id, message.message_id, reply_markup=markup)
-
-    def select_ban_user(self, message: Message, id: int):
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("SELECT thread_id FROM topics WHERE user_id = ? LIMIT 1", (id,))
-            thread_id = db_cursor.fetchone()
-            if thread_id is None:
-                self.bot.send_message(self.group_id, _("User not found"))
-                return
-            markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("❌" + _("Unban"),
-                                                  callback_data=json.dumps({"action": "unban_user", "id": id}))
-                       )
-            markup.add(types.InlineKeyboardButton("⬅️" + _("Back"),
-                                                  callback_data=json.dumps({"action": "ban_user"})))
-            self.bot.edit_message_text(f"User ID: {id}", message.chat.id, message.message_id, reply_markup=markup)
-
-    def default_msg_menu(self, message: Message):
-        if not self.check_valid_chat(message):
-            return
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("✏️" + _("Edit Message"),
-                                              callback_data=json.dumps({"action": "edit_default_msg"})))
-        markup.add(types.InlineKeyboardButton("🔄️" + _("Set to Default"),
-                                              callback_data=json.dumps({"action": "empty_default_msg"})))
-        markup.add(types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "menu"})))
-        self.bot.edit_message_text(_("Default Message") +
-                                   "\n" +
-                                   _("The default message is an auto-reply to the commands /help and /start"),
-                                   message.chat.id, message.message_id, reply_markup=markup)
-
-    def empty_default_msg(self, message: Message):
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("UPDATE settings SET value = NULL WHERE key = 'default_message'")
-            db.commit()
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "menu"}))
-                   )
-        self.bot.edit_message_text(_("Default message has been restored."), message.chat.id, message.message_id,
-                                   reply_markup=markup)
-
-    def edit_default_msg(self, message: Message):
-        msg = self.bot.edit_message_text(text=_(
-            "Let's set up the default message.\nSend /cancel to cancel this operation.\n\n"
-            "Please send me the response."),
-            chat_id=self.group_id, message_id=message.message_id)
-        self.bot.register_next_step_handler(msg, self.edit_default_msg_handle)
-
-    def edit_default_msg_handle(self, message: Message):
-        if not isinstance(message.text, str):
-            self.bot.send_message(self.group_id, _("Invalid input"))
-            return
-        if message.text == "/cancel":
-            self.bot.send_message(self.group_id, _("Operation cancelled"))
-            return
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("UPDATE settings SET value = ? WHERE key = 'default_message'", (message.text,))
-            db.commit()
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "menu"}))
-                   )
-        self.bot.send_message(self.group_id, _("Default message has been updated."), reply_markup=markup)
-
-    def callback_query(self, call: types.CallbackQuery):
-        if call.data == "null":
-            logger.error(_("Invalid callback data received"))
-            return
-        try:
-            data = json.loads(call.data)
-            action = data["action"]
-        except json.JSONDecodeError:
-            logger.error(_("Invalid JSON data received"))
-            return
-
-        # User end
-        match action:
-            case "verify_button":
-                self.handle_button_captcha(call)
-                return
-
-        # Admin end
-        if call.message.chat.id != self.group_id or call.message.message_thread_id is not None:
-            return
-        markup = types.InlineKeyboardMarkup()
-        back_button = types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "menu"}))
-        match action:
-            case "menu":
-                self.menu(call.message, edit=True)
-            case "auto_reply":
-                markup.add(types.InlineKeyboardButton("➕" + _("Add Auto Reply"),
-                                                      callback_data=json.dumps({"action": "start_add_auto_reply"}))
-                           )
-                markup.add(types.InlineKeyboardButton("⚙️" + _("Manage Existing Auto Reply"),
-                                                      callback_data=json.dumps({"action": "manage_auto_reply"}))
-                           )
-                markup.add(back_button)
-                self.bot.edit_message_text(_("Auto Reply"), call.message.chat.id, call.message.message_id,
-                                           reply_markup=markup)
-            case "set_auto_reply_type":
-                if "regex" not in data:
-                    self.bot.delete_message(self.group_id, call.message.message_id)
-                    self.bot.send_message(self.group_id, _("Invalid action"), reply_markup=markup)
-                    return
-                self.cache.set("auto_response_regex", data["regex"], 300)
-                self.add_auto_response_value(call.message)
-            case "start_add_auto_reply":
-                self.add_auto_response(call.message)
-            case "add_auto_reply":
-                self.process_add_auto_reply(call.message, data)
-            case "manage_auto_reply":
-                self.manage_auto_reply(call.message, page=data.get("page", 1))
-            case "select_auto_reply":
-                if "id" not in data:
-                    self.bot.delete_message(self.group_id, call.message.message_id)
-                    self.bot.send_message(self.group_id, _("Invalid action"), reply_markup=markup)
-                    return
-                self.select_auto_reply(call.message, data["id"])
-            case "delete_auto_reply":
-                if "id" not in data:
-                    self.bot.delete_message(self.group_id, call.message.message_id)
-                    self.bot.send_message(self.group_id, _("Invalid action"), reply_markup=markup)
-                    return
-                self.delete_auto_reply(call.message, data["id"])
-            case "ban_user":
-                self.manage_ban_user(call.message)
-            case "unban_user":
-                if "id" not in data:
-                    self.bot.delete_message(self.group_id, call.message.message_id)
-                    self.bot.send_message(self.group_id, _("Invalid action"), reply_markup=markup)
-                    return
-                self.unban_user(call.message, user_id=data["id"])
-            case "select_ban_user":
-                if "id" not in data:
-                    self.bot.delete_message(self.group_id, call.message.message_id)
-                    self.bot.send_message(self.group_id, _("Invalid action"), reply_markup=markup)
-                    return
-                self.select_ban_user(call.message, data["id"])
-            case "default_msg":
-                self.default_msg_menu(call.message)
-            case "edit_default_msg":
-                self.edit_default_msg(call.message)
-            case "empty_default_msg":
-                self.empty_default_msg(call.message)
-            case "captcha_settings":
-                self.captcha_settings_menu(call.message)
-            case "set_captcha":
-                self.set_captcha(call.message, data["value"])
-            case "broadcast_message":
-                self.broadcast_message(call.message)
-            case "confirm_broadcast":
-                self.bot.delete_message(self.group_id, call.message.message_id)
-                self.confirm_broadcast_message(call)
-            case "cancel_broadcast":
-                self.bot.delete_message(self.group_id, call.message.message_id)
-                self.bot.send_message(self.group_id, _("Broadcast cancelled"))
-                self.cache.delete("broadcast_content")
-                self.cache.delete("broadcast_content_type")
-            case _:
-                logger.error(_("Invalid action received") + action)
-        return
-
-    def captcha_settings_menu(self, message: Message):
-        captcha_list = {
-            _("Disable Captcha"): "disable",
-            _("Math Captcha"): "math",
-            _("Button Captcha"): "button",
-        }
-        if not self.check_valid_chat(message):
-            return
-        markup = types.InlineKeyboardMarkup()
-        for key, value in captcha_list.items():
-            icon = "✅" + _("(Selected) ") if self.get_setting("captcha") == value else "⚪"
-            markup.add(types.InlineKeyboardButton(icon + key,
-                                                  callback_data=json.dumps({"action": "set_captcha", "value": value})))
-        markup.add(types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "menu"})))
-        self.bot.edit_message_text(_("Captcha Settings") + "\n", message.chat.id, message.message_id,
-                                   reply_markup=markup)
-
-    def set_captcha(self, message: Message, value: str):
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("UPDATE settings SET value = ? WHERE key = 'captcha'", (value,))
-            db.commit()
-        markup = types.InlineKeyboardMarkup()
-        markup.add(types.InlineKeyboardButton("⬅️" + _("Back"), callback_data=json.dumps({"action": "menu"})))
-        self.cache.set("setting_captcha", value)
-        self.bot.edit_message_text(_("Captcha settings updated"), message.chat.id, message.message_id,
-                                   reply_markup=markup)
-
-    def handle_edit(self, message: Message):
-        if self.check_valid_chat(message):
-            return
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute(
-                "SELECT topic_id, forwarded_id FROM messages WHERE received_id = ? AND in_group = ? LIMIT 1",
-                (message.message_id, message.chat.id == self.group_id,))
-            if (result := db_cursor.fetchone()) is None:
-                return
-            topic_id, forwarded_id = result
-            if message.chat.id == self.group_id:
-                db_cursor.execute("SELECT user_id FROM topics WHERE thread_id = ? LIMIT 1", (topic_id,))
-                if (user_id := db_cursor.fetchone()[0]) is None:
-                    return
-                match message.content_type:
-                    case "text":
-                        self.bot.edit_message_text(chat_id=user_id, message_id=forwarded_id, text=message.text)
-            else:
-                match message.content_type:
-                    case "text":
-                        self.bot.edit_message_text(chat_id=self.group_id, message_id=forwarded_id,
-                                                   text=message.text + "\n\n" + _("(edited)"))
-
-    def delete_message(self, message: Message):
-        if self.check_valid_chat(message):
-            return
-        if message.reply_to_message is None:
-            self.bot.reply_to(message, _("Please reply to the message you want to delete"))
-            return
-        msg_id = message.reply_to_message.message_id
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute(
-                "SELECT topic_id, forwarded_id FROM messages WHERE received_id = ? AND in_group = ? LIMIT 1",
-                (msg_id, message.chat.id == self.group_id,))
-            if (result := db_cursor.fetchone()) is None:
-                return
-            topic_id, forwarded_id = result
-            if message.chat.id == self.group_id:
-                db_cursor.execute("SELECT user_id FROM topics WHERE thread_id = ? LIMIT 1", (topic_id,))
-                if (user_id := db_cursor.fetchone()[0]) is None:
-                    return
-                self.bot.delete_message(chat_id=user_id, message_id=forwarded_id)
-            else:
-                self.bot.delete_message(chat_id=self.group_id, message_id=forwarded_id)
-
-            # Delete the message from the database
-            db_cursor.execute("DELETE FROM messages WHERE received_id = ? AND in_group = ?",
-                              (msg_id, message.chat.id == self.group_id))
-            db.commit()
-
-        # Delete the current message
-        self.bot.delete_message(chat_id=message.chat.id, message_id=message.reply_to_message.id)
-        self.bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
-
-    def broadcast_message(self, message: Message):
-        if not self.check_valid_chat(message):
-            return
-        msg = self.bot.edit_message_text(text=_(
-            "Please send the content you want to broadcast.\nSend /cancel to cancel this operation."),
-            chat_id=self.group_id, message_id=message.message_id)
-        self.bot.register_next_step_handler(msg, self.handle_broadcast_message)
-
-    def handle_broadcast_message(self, message: Message):
-        if (isinstance(message.text, str) and message.text.startswith("/cancel")) or not self.check_valid_chat(message):
-            self.bot.send_message(self.group_id, _("Operation cancelled"))
-            return
-
-        content_type = message.content_type
-        if content_type == "text":
-            content = message.text
-        elif content_type == "photo":
-            content = message.photo[-1].file_id
-        elif content_type == "document":
-            content = message.document.file_id
-        elif content_type == "video":
-            content = message.video.file_id
-        elif content_type == "sticker":
-            content = message.sticker.file_id
-        else:
-            self.bot.send_message(self.group_id, _("Unsupported message type"))
-            return
-
-        # Store the message content and type in cache
-        self.cache.set("broadcast_content", content, 300)
-        self.cache.set("broadcast_content_type", content_type, 300)
-
-        # Send preview message with confirmation button
-        markup = types.InlineKeyboardMarkup()
-        markup.add(
-            types.InlineKeyboardButton("✅" + _("Confirm"), callback_data=json.dumps({"action": "confirm_broadcast"})))
-        markup.add(
-            types.InlineKeyboardButton("❌" + _("Cancel"), callback_data=json.dumps({"action": "cancel_broadcast"})))
-
-        if content_type == "text":
-            self.bot.send_message(self.group_id, content, reply_markup=markup)
-        elif content_type == "photo":
-            self.bot.send_photo(self.group_id, content, reply_markup=markup)
-        elif content_type == "document":
-            self.bot.send_document(self.group_id, content, reply_markup=markup)
-        elif content_type == "video":
-            self.bot.send_video(self.group_id, content, reply_markup=markup)
-        elif content_type == "sticker":
-            self.bot.send_sticker(self.group_id, content, reply_markup=markup)
-
-    def confirm_broadcast_message(self, call: types.CallbackQuery):
-        content = self.cache.get("broadcast_content")
-        content_type = self.cache.get("broadcast_content_type")
-
-        if content is None or content_type is None:
-            self.bot.send_message(self.group_id, _("The operation has timed out. Please initiate the process again."))
-            return
-
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("SELECT user_id, thread_id FROM topics")
-            users = db_cursor.fetchall()
-            for user in users:
-                user_id, thread_id = user
-                try:
-                    if content_type == "text":
-                        self.bot.send_message(user_id, content)
-                    elif content_type == "photo":
-                        self.bot.send_photo(user_id, content)
-                    elif content_type == "document":
-                        self.bot.send_document(user_id, content)
-                    elif content_type == "video":
-                        self.bot.send_video(user_id, content)
-                    elif content_type == "sticker":
-                        self.bot.send_sticker(user_id, content)
-                except ApiTelegramException as e:
-                    self.bot.send_message(self.group_id, _("Failed to send message to user {}").format(user_id))
-                    logger.error(_("Failed to send message to user {}").format(user_id))
-
-        self.bot.send_message(self.group_id, _("Broadcast message sent successfully."))
-        self.cache.delete("broadcast_content")
-        self.cache.delete("broadcast_content_type")
-
-    def handle_verify(self, message: Message):
-        if message.chat.id != self.group_id or message.message_thread_id is None:
-            return
-
-        command_parts = message.text.split()
-        if len(command_parts) != 2 or command_parts[1].lower() not in ["true", "false"]:
-            self.bot.send_message(message.chat.id, _("Invalid command format.\nUse /verify <true/false>"),
-                                  message_thread_id=message.message_thread_id)
-            return
-
-        verified_status = command_parts[1].lower() == "true"
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            db_cursor.execute("SELECT user_id FROM topics WHERE thread_id = ?", (message.message_thread_id,))
-            user_id = db_cursor.fetchone()
-            if user_id is None:
-                self.bot.send_message(message.chat.id, _("User not found"), message_thread_id=message.message_thread_id)
-                return
-            user_id = user_id[0]
-            if verified_status:
-                db_cursor.execute("INSERT OR REPLACE INTO verified_users (user_id) VALUES (?)", (user_id,))
-                self.bot.send_message(message.chat.id, _("User verified successfully."),
-                                      message_thread_id=message.message_thread_id)
-                self.cache.set("verified_users", user_id, 300)
-            else:
-                db_cursor.execute("DELETE FROM verified_users WHERE user_id = ?", (user_id,))
-                self.bot.send_message(message.chat.id, _("User verification removed."),
-                                      message_thread_id=message.message_thread_id)
-                self.cache.delete("verified_users")
-
-            db.commit()
-
-    def handle_reaction(self, message: MessageReactionUpdated):
-        if message.chat.id == self.group_id and message.chat.is_forum:
-            return
-        with sqlite3.connect(self.db_path) as db:
-            db_cursor = db.cursor()
-            in_group = not (message.chat.id == self.group_id)
-            db_cursor.execute(
-                "SELECT topic_id, received_id FROM messages WHERE forwarded_id = ? AND in_group = ? LIMIT 1",
-                (message.message_id, in_group)
-            )
-            result = db_cursor.fetchone()
-            if result is None:
-                db_cursor.execute(
-                    "SELECT topic_id, forwarded_id FROM messages WHERE received_id = ? AND in_group = ? LIMIT 1",
-                    (message.message_id, not in_group)
-                )
-                result = db_cursor.fetchone()
-            if result is None:
-                return
-            topic_id, forwarded_id = result
-            if in_group:
-                self.bot.set_message_reaction(chat_id=self.group_id, message_id=forwarded_id,
-                                              reaction=[message.new_reaction[-1]] if message.new_reaction else [])
-            else:
-                db_cursor.execute("SELECT user_id FROM topics WHERE thread_id = ? LIMIT 1", (topic_id,))
-                user_id = db_cursor.fetchone()
-                self.bot.set_message_reaction(chat_id=user_id, message_id=forwarded_id,
-                                              reaction=[message.new_reaction[-1]] if message.new_reaction else [])
-
-
-if __name__ == "__main__":
-    if not args.token or not args.group_id:
-        logger.error(_("Token or group ID is empty"))
-        exit(1)
-    try:
-        bot = TGBot(args.token, args.group_id)
-    except KeyboardInterrupt:
-        logger.info(_("Exiting..."))
-        exit(0)
+import argparse
+import atexit
+import gettext
+import importlib
+import json
+import logging
+import os
+import queue
+import random
+import re
+import signal
+import sqlite3
+import threading
+import time
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from logging.handlers import QueueHandler, QueueListener
+from traceback import print_exc
+
+import requests
+from diskcache import Cache
+from requests.adapters import HTTPAdapter
+from telebot import apihelper, types, TeleBot
+from telebot.apihelper import create_forum_topic, close_forum_topic, ApiTelegramException, delete_forum_topic, \
+    reopen_forum_topic
+from telebot.types import Message, MessageReactionUpdated
+
+parser = argparse.ArgumentParser(description="")
+parser.add_argument("-token", type=str, required=True, help="Telegram bot token")
+parser.add_argument("-group_id", type=str, required=True, help="Group ID")
+parser.add_argument("-language", type=str, default="en_US", help="Language", choices=["en_US", "zh_CN", "ja_JP"])
+parser.add_argument("-workers", type=int, default=4, help="Number of message workers")
+args = parser.parse_args()
+
+logger = logging.getLogger()
+logger.setLevel("INFO")
+BASIC_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+formatter = logging.Formatter(BASIC_FORMAT, DATE_FORMAT)
+chlr = logging.StreamHandler()
+chlr.setFormatter(formatter)
+# Records are written to the console by a listener thread, so logging never blocks the calling thread on I/O
+log_listener = QueueListener(log_queue := queue.Queue(-1), chlr, respect_handler_level=True)
+logger.addHandler(QueueHandler(log_queue))
+log_listener.start()
+atexit.register(log_listener.stop)
+
+project_root = os.path.dirname(os.path.abspath(__file__))
+locale_dir = os.path.join(project_root, "locale")
+gettext.bindtextdomain("BetterForward", locale_dir)
+gettext.textdomain("BetterForward")
+try:
+    _ = gettext.translation("BetterForward", locale_dir, languages=[args.language]).gettext
+except FileNotFoundError:
+    _ = gettext.gettext
+
+# Button labels used on every render, translated once since the language is fixed at startup
+BACK_LABEL = "⬅️" + _("Back")
+PREVIOUS_PAGE_LABEL = "⬅️" + _("Previous Page")
+NEXT_PAGE_LABEL = "➡️" + _("Next Page")
+DELETE_LABEL = "❌" + _("Delete")
+UNBAN_LABEL = "❌" + _("Unban")
+YES_LABEL = "✅" + _("Yes")
+NO_LABEL = "❌" + _("No")
+FORWARD_LABEL = "✅" + _("Forward message")
+NO_FORWARD_LABEL = "❌" + _("Do not forward message")
+EDIT_MESSAGE_LABEL = "✏️" + _("Edit Message")
+SET_TO_DEFAULT_LABEL = "🔄️" + _("Set to Default")
+CONFIRM_LABEL = "✅" + _("Confirm")
+CANCEL_LABEL = "❌" + _("Cancel")
+SELECTED_LABEL = "✅" + _("(Selected) ")
+MENU_TEXT = _("Menu")
+DIVIDER = "-" * 20
+
+# Auto reply details, filled with trigger, response, forward and regex marks
+AUTO_REPLY_DETAILS = "\n".join((_("Trigger: {}"), _("Response: {}"), _("Forward message: {}"),
+                                _("Is regex: {}"))) + "\n\n"
+# One entry of the auto reply list, the same details preceded by the divider and ID
+AUTO_REPLY_ENTRY = DIVIDER + "\nID: {}\n" + AUTO_REPLY_DETAILS
+# List headers filled with the total, followed by the page line filled with the page and the page count
+AUTO_REPLY_LIST_HEADER = _("Auto Reply List:") + "\n" + _("Total: {}") + "\n"
+BANNED_LIST_HEADER = _("Banned User List:") + "\n" + _("Total: {}") + "\n"
+PAGE_LINE = _("Page: {}") + "/{}"
+
+# Captcha setting value -> display name, in menu order
+CAPTCHA_OPTIONS = {
+    "disable": _("Disable Captcha"),
+    "math": _("Math Captcha"),
+    "button": _("Button Captcha"),
+}
+
+# Callback data is "action" or "action:arg:...", the args in the order of the action's keys and left
+# empty for an omitted optional one. This keeps payloads well under Telegram's 64 byte limit.
+CB_MENU = "menu"
+CB_AUTO_REPLY = "auto_reply"
+CB_START_ADD_AUTO_REPLY = "start_add_auto_reply"
+CB_MANAGE_AUTO_REPLY = "manage_auto_reply"
+CB_BAN_USER = "ban_user"
+CB_DEFAULT_MSG = "default_msg"
+CB_EDIT_DEFAULT_MSG = "edit_default_msg"
+CB_EMPTY_DEFAULT_MSG = "empty_default_msg"
+CB_CAPTCHA_SETTINGS = "captcha_settings"
+CB_BROADCAST_MESSAGE = "broadcast_message"
+CB_CONFIRM_BROADCAST = "confirm_broadcast"
+CB_CANCEL_BROADCAST = "cancel_broadcast"
+CB_AUTO_REPLY_REGEX = "set_auto_reply_type:1"
+CB_AUTO_REPLY_PLAIN = "set_auto_reply_type:0"
+CB_ADD_AUTO_REPLY = "add_auto_reply"
+CB_ADD_AUTO_REPLY_FORWARD = "add_auto_reply:1"
+CB_ADD_AUTO_REPLY_NO_FORWARD = "add_auto_reply:0"
+CB_SET_CAPTCHA = {value: f"set_captcha:{value}" for value in CAPTCHA_OPTIONS}
+
+
+# Keys of the settings table
+class SettingKey:
+    DB_VERSION = "db_version"
+    CAPTCHA = "captcha"
+    DEFAULT_MESSAGE = "default_message"
+
+
+# Migration files are named <version>_<description>.py
+MIGRATION_RE = re.compile(r"^((\d+)_\w+)\.py$")
+
+# Content type -> the text or file id a message of that type carries
+MESSAGE_CONTENT = {
+    "text": lambda message: message.text,
+    "photo": lambda message: message.photo[-1].file_id,
+    "document": lambda message: message.document.file_id,
+    "video": lambda message: message.video.file_id,
+    "sticker": lambda message: message.sticker.file_id,
+}
+
+# Arguments accepted by /verify
+VERIFY_ARGUMENTS = {"true": True, "false": False}
+
+# /cancel, optionally addressed to the bot, but not commands that merely start with it
+CANCEL_RE = re.compile(r"/cancel(?:@\w+)?(?:\s|$)")
+
+# Auto reply triggers are matched against every incoming message, so keep them short and
+# refuse regular expressions that repeat a group containing a repetition, e.g. (a+)+ or (\w+\s?)+
+# This is only a heuristic screen, not a guarantee: it also refuses safe patterns such as (?:ab+)+
+# and lets through other slow ones such as (a|a)*
+MAX_TRIGGER_LENGTH = 512
+NESTED_QUANTIFIER_RE = re.compile(r"\([^()]*[+*}][^()]*\)[+*{]")
+
+# Telegram allows bots about 30 messages per second in total, keep some room for regular traffic
+BROADCAST_RATE = 25
+BROADCAST_WORKERS = 8
+# Sends queued ahead of the workers, so a broadcast holds a few futures at a time rather than one per recipient
+BROADCAST_PENDING = BROADCAST_WORKERS * 4
+# Recipients read per query, each batch is a short statement so no read snapshot outlives it
+BROADCAST_BATCH = 500
+# User ids listed in the broadcast failure report, the rest are only counted
+BROADCAST_FAILURE_PREVIEW = 50
+# Users that refused a broadcast are skipped for a day, then tried again in case they unblocked the bot
+BLOCKED_RETRY_INTERVAL = 24 * 60 * 60
+
+# Chat member attributes the bot needs in the group, with their display names
+REQUIRED_PERMISSIONS = (
+    ("can_manage_topics", _("Manage Topics")),
+    ("can_delete_messages", _("Delete Messages")),
+)
+
+
+def handle_sigterm(*args):
+    raise KeyboardInterrupt()
+
+
+# Split callback data into its action and args. Buttons sent before the compact format carry a JSON
+# object, its keys are returned as a dict instead.
+def parse_callback_data(data: str) -> tuple[str, list | dict]:
+    if data.startswith("{"):
+        args = json.loads(data)
+        return args.pop("action"), args
+    action, *args = data.split(":")
+    return action, [int(arg) if arg.isdigit() else arg for arg in args]
+
+
+# Name the parsed callback args after the action's keys, leaving out the omitted ones
+def callback_args(args: list | dict, keys: tuple) -> dict:
+    if isinstance(args, dict):
+        return {key: args[key] for key in keys if key in args}
+    return {key: arg for key, arg in zip(keys, args) if arg != ""}
+
+
+def escape_markdown(text):
+    escape_chars = r'\*_`\[\]()'
+    return re.sub(f'([{escape_chars}])', r'\\\1', text)
+
+
+signal.signal(signal.SIGTERM, handle_sigterm)
+signal.signal(signal.SIGINT, handle_sigterm)
+
+
+class DatabaseUpgradeError(RuntimeError):
+    pass
+
+
+# Token bucket shared between threads, acquire() blocks until a token is available
+class RateLimiter:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Take the token now and sleep off the debt outside the lock
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    # Hold back every caller for the given time, as when Telegram asks to retry after a rate limit
+    def pause(self, seconds: float):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Taking the minimum rather than adding keeps simultaneous pauses from stacking up
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+# Call the Telegram API, retrying rate limits and connection failures with exponential backoff
+# Only errors raised before Telegram got the request are retried, ConnectTimeout being a ConnectionError too
+# A read timeout may follow a completed call, and repeating a send or a topic creation would duplicate it
+# With a limiter every attempt takes a token, and a rate limit pauses the limiter for all of its callers
+def call_with_retry(func, *args, attempts: int = 3, limiter: RateLimiter = None, **kwargs):
+    for attempt in range(attempts):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return func(*args, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code != 429 or attempt == attempts - 1:
+                raise
+            delay = e.result_json.get("parameters", {}).get("retry_after", 2 ** attempt)
+            if limiter is not None:
+                limiter.pause(delay)
+                continue
+        except requests.ConnectionError:
+            if attempt == attempts - 1:
+                raise
+            delay = 0.5 * 2 ** attempt
+        time.sleep(delay)
+
+
+class Database:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # Check path exists
+        if not os.path.exists(os.path.dirname(db_path)):
+            os.makedirs(os.path.dirname(db_path))
+        self.upgrade_db()
+        self.init_db()
+        # Handler threads are long-lived, so each one keeps its own connection open
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+        # Writers queue up here rather than spinning on SQLite's busy handler, readers never wait under WAL
+        self.write_lock = threading.RLock()
+        atexit.register(self.close)
+        # The settings table is small, keep it in memory and write changes through
+        self.settings = self.load_all_settings()
+        # Regex auto replies are tried against every incoming message, keep them compiled in memory
+        self.regex_auto_responses = self.load_regex_auto_responses()
+        # Every incoming message is checked against the bans, keep the banned user ids in memory and write through
+        self.banned_users = self.load_banned_users()
+
+    def upgrade_db(self):
+        try:
+            with closing(sqlite3.connect(self.db_path)) as db:
+                current_version = int(db.execute("SELECT value FROM settings WHERE key = ?",
+                                                 (SettingKey.DB_VERSION,)).fetchone()[0])
+        except sqlite3.OperationalError:
+            current_version = 0
+        # Only pending migrations are imported, in version order
+        pending = sorted((int(match[2]), match[1]) for file in os.listdir("./db_migrate")
+                         if (match := MIGRATION_RE.match(file)) and int(match[2]) > current_version)
+        if not pending:
+            return
+        # All pending migrations and the version bump commit together, a failure leaves the database untouched
+        db = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for version, module_name in pending:
+                logger.info(_("Upgrading database to version {}").format(version))
+                importlib.import_module(f"db_migrate.{module_name}").upgrade(db)
+                db.execute("UPDATE settings SET value = ? WHERE key = ?", (str(version), SettingKey.DB_VERSION))
+            db.execute("COMMIT")
+        except Exception as e:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            raise DatabaseUpgradeError(_("Failed to upgrade database")) from e
+        finally:
+            db.close()
+
+    # The journal mode is stored in the database file, so it only needs to be set once
+    # Statistics are also persisted, in sqlite_stat1, and picked up by every connection opened afterwards
+    def init_db(self):
+        with closing(sqlite3.connect(self.db_path)) as db:
+            # WAL lets readers proceed while a write is in progress
+            db.execute("PRAGMA journal_mode=WAL")
+            # Refresh planner statistics at startup, sampling each index so large tables stay cheap to analyze
+            db.execute("PRAGMA analysis_limit=400")
+            db.execute("ANALYZE")
+
+    def connect(self) -> sqlite3.Connection:
+        # timeout installs SQLite's busy handler, no separate busy_timeout PRAGMA is needed
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        # With WAL, NORMAL only skips the fsync on commit and cannot corrupt the database
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Page cache of about 10 MB, so lookups in the growing messages table stay in memory
+        conn.execute("PRAGMA cache_size=-10000")
+        # Read pages through a memory map instead of copying them with read()
+        conn.execute("PRAGMA mmap_size=268435456")
+        # Sorting for DISTINCT and ORDER BY without a usable index builds its temporary b-trees in memory
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        if (conn := getattr(self.local, "conn", None)) is None:
+            conn = self.local.conn = self.connect()
+            with self.connections_lock:
+                self.connections.append(conn)
+        return conn
+
+    # Closing the last connection also checkpoints the WAL and removes the -wal and -shm files
+    # Called from the bot's shutdown and again at exit, the second call finds nothing left to close
+    def close(self):
+        with self.connections_lock:
+            for conn in self.connections:
+                try:
+                    # Let SQLite refresh the planner statistics for the queries this connection ran
+                    conn.execute("PRAGMA optimize")
+                except sqlite3.Error as e:
+                    logger.warning(_("Failed to optimize the database: {}").format(e))
+                finally:
+                    conn.close()
+            self.connections.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def load_all_settings(self) -> dict:
+        return dict(self.connection().execute("SELECT key, value FROM settings"))
+
+    def get_all_settings(self) -> dict:
+        return dict(self.settings)
+
+    def get_setting(self, key: str):
+        return self.settings.get(key)
+
+    def set_setting(self, key: str, value):
+        # Keep the table and the in-memory copy in the same order when settings are changed concurrently
+        with self.write_lock:
+            self.execute("INSERT INTO settings (key, value) VALUES (?, ?) "
+                         "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+            self.settings[key] = value
+
+    # Run a write statement and commit it
+    def execute(self, sql: str, params: tuple = ()):
+        with self.write_lock, (conn := self.connection()):
+            conn.execute(sql, params)
+
+    def fetch_one(self, sql: str, params: tuple = ()):
+        return self.connection().execute(sql, params).fetchone()
+
+    def fetch_all(self, sql: str, params: tuple = ()) -> list:
+        return self.connection().execute(sql, params).fetchall()
+
+    def fetch_value(self, sql: str, params: tuple = ()):
+        return None if (row := self.fetch_one(sql, params)) is None else row[0]
+
+    # Topics
+    def get_thread_id(self, user_id: int):
+        return self.fetch_value("SELECT thread_id FROM topics WHERE user_id = ? LIMIT 1", (user_id,))
+
+    def get_user_id(self, thread_id: int):
+        return self.fetch_value("SELECT user_id FROM topics WHERE thread_id = ? LIMIT 1", (thread_id,))
+
+    def add_topic(self, user_id: int, thread_id: int):
+        self.execute("INSERT INTO topics (user_id, thread_id) VALUES (?, ?)", (user_id, thread_id))
+
+    def delete_topic(self, thread_id: int):
+        with self.write_lock:
+            with (conn := self.connection()):
+                deleted = conn.execute("DELETE FROM topics WHERE thread_id = ? RETURNING user_id",
+                                       (thread_id,)).fetchall()
+                conn.execute("DELETE FROM messages WHERE topic_id = ?", (thread_id,))
+            self.banned_users.difference_update(user_id for (user_id,) in deleted)
+
+    def list_topics(self) -> list[tuple[int, int]]:
+        return self.fetch_all("SELECT user_id, thread_id FROM topics")
+
+    # Read recipients in keyset batches, a cursor held open for the whole broadcast would pin the WAL
+    def iter_broadcast_recipients(self) -> Iterator[int]:
+        retry_before = int(time.time()) - BLOCKED_RETRY_INTERVAL
+        # The smallest SQLite integer, so the first batch starts at the lowest user id
+        last_user_id = -2 ** 63
+        while True:
+            batch = self.fetch_all("SELECT DISTINCT user_id FROM topics "
+                                   "WHERE user_id > ? AND ban = 0 AND (blocked_at IS NULL OR blocked_at < ?) "
+                                   "ORDER BY user_id LIMIT ?", (last_user_id, retry_before, BROADCAST_BATCH))
+            for (user_id,) in batch:
+                yield user_id
+            if len(batch) < BROADCAST_BATCH:
+                return
+            last_user_id = batch[-1][0]
+
+    # Record every user that refused a broadcast in one transaction
+    def mark_blocked(self, user_ids: list[int]):
+        blocked_at = int(time.time())
+        with self.write_lock, (conn := self.connection()):
+            conn.executemany("UPDATE topics SET blocked_at = ? WHERE user_id = ?",
+                             [(blocked_at, user_id) for user_id in user_ids])
+
+    # Bans
+    def load_banned_users(self) -> set[int]:
+        return {user_id for (user_id,) in self.fetch_all("SELECT DISTINCT user_id FROM topics WHERE ban = 1")}
+
+    def is_banned(self, user_id: int) -> bool:
+        return user_id in self.banned_users
+
+    # Ban the user of a topic and drop their verification in the same transaction
+    def ban_thread(self, thread_id: int):
+        with self.write_lock:
+            with (conn := self.connection()):
+                banned = conn.execute("UPDATE topics SET ban = 1 WHERE thread_id = ? RETURNING user_id",
+                                      (thread_id,)).fetchall()
+                conn.execute("DELETE FROM verified_users WHERE user_id IN "
+                             "(SELECT user_id FROM topics WHERE thread_id = ?)", (thread_id,))
+            self.banned_users.update(user_id for (user_id,) in banned)
+
+    def unban_thread(self, thread_id: int):
+        with self.write_lock:
+            with (conn := self.connection()):
+                unbanned = conn.execute("UPDATE topics SET ban = 0 WHERE thread_id = ? RETURNING user_id",
+                                        (thread_id,)).fetchall()
+            self.banned_users.difference_update(user_id for (user_id,) in unbanned)
+
+    def unban_user(self, user_id: int):
+        with self.write_lock:
+            self.execute("UPDATE topics SET ban = 0 WHERE user_id = ?", (user_id,))
+            self.banned_users.discard(user_id)
+
+    # One page of banned users along with the total, counted by the same statement
+    # Pages seek past the user ids already shown instead of skipping rows with OFFSET
+    def page_banned(self, limit: int, after: int = None, before: int = None) -> tuple[list[int], int]:
+        if before is not None:
+            rows = self.fetch_all("SELECT user_id, (SELECT COUNT(*) FROM topics WHERE ban = 1) FROM topics "
+                                  "WHERE ban = 1 AND user_id < ? ORDER BY user_id DESC LIMIT ?", (before, limit))[::-1]
+        else:
+            rows = self.fetch_all("SELECT user_id, (SELECT COUNT(*) FROM topics WHERE ban = 1) FROM topics "
+                                  "WHERE ban = 1 AND user_id > ? ORDER BY user_id LIMIT ?", (after or 0, limit))
+        return [row[0] for row in rows], rows[0][1] if rows else 0
+
+    # Verification
+    def is_verified(self, user_id: int) -> bool:
+        return self.fetch_one("SELECT 1 FROM verified_users WHERE user_id = ? LIMIT 1", (user_id,)) is not None
+
+    def set_verified(self, user_id: int, verified: bool = True):
+        if verified:
+            self.execute("INSERT INTO verified_users (user_id) VALUES (?)", (user_id,))
+        else:
+            self.execute("DELETE FROM verified_users WHERE user_id = ?", (user_id,))
+
+    # Forwarded messages
+    def add_message(self, received_id: int, forwarded_id: int, topic_id: int, in_group: bool):
+        self.execute("INSERT INTO messages (received_id, forwarded_id, topic_id, in_group) VALUES (?, ?, ?, ?)",
+                     (received_id, forwarded_id, topic_id, in_group))
+
+    def get_forwarded_id(self, received_id: int, topic_id: int, in_group: bool):
+        return self.fetch_value(
+            "SELECT forwarded_id FROM messages WHERE received_id = ? AND topic_id = ? AND in_group = ? LIMIT 1",
+            (received_id, topic_id, in_group))
+
+    def get_received_id(self, forwarded_id: int, topic_id: int, in_group: bool):
+        return self.fetch_value(
+            "SELECT received_id FROM messages WHERE forwarded_id = ? AND topic_id = ? AND in_group = ? LIMIT 1",
+            (forwarded_id, topic_id, in_group))
+
+    # Returns (topic_id, forwarded_id) of a received message
+    def find_by_received(self, received_id: int, in_group: bool):
+        return self.fetch_one(
+            "SELECT topic_id, forwarded_id FROM messages WHERE received_id = ? AND in_group = ? LIMIT 1",
+            (received_id, in_group))
+
+    # Returns (topic_id, received_id) of a forwarded message
+    def find_by_forwarded(self, forwarded_id: int, in_group: bool):
+        return self.fetch_one(
+            "SELECT topic_id, received_id FROM messages WHERE forwarded_id = ? AND in_group = ? LIMIT 1",
+            (forwarded_id, in_group))
+
+    def delete_message(self, received_id: int, in_group: bool):
+        self.execute("DELETE FROM messages WHERE received_id = ? AND in_group = ?", (received_id, in_group))
+
+    # Auto responses
+    def add_auto_response(self, key: str, value: str, topic_action: bool, is_regex: bool, type: str):
+        with self.write_lock:
+            self.execute("INSERT INTO auto_response (key, value, topic_action, is_regex, type) VALUES (?, ?, ?, ?, ?)",
+                         (key, value, topic_action, is_regex, type))
+            if not is_regex:
+                return
+            # re.compile returns the pattern cached when the trigger was validated
+            try:
+                pattern = re.compile(key)
+            except re.error:
+                logger.error(_("Invalid regular expression: {}").format(key))
+                return
+            # The new row has the highest id, appending keeps the list in id order without reloading the table
+            self.regex_auto_responses = [*self.regex_auto_responses, (pattern, value, topic_action, type)]
+
+    def get_auto_response(self, id: int):
+        return self.fetch_one("SELECT key, value, topic_action, is_regex, type FROM auto_response WHERE id = ? LIMIT 1",
+                              (id,))
+
+    def delete_auto_response(self, id: int):
+        with self.write_lock:
+            self.execute("DELETE FROM auto_response WHERE id = ?", (id,))
+            self.regex_auto_responses = self.load_regex_auto_responses()
+
+    def find_auto_response(self, key: str):
+        return self.fetch_one(
+            "SELECT value, topic_action, type FROM auto_response WHERE key = ? AND is_regex = 0 LIMIT 1", (key,))
+
+    def load_regex_auto_responses(self) -> list:
+        auto_responses = []
+        for key, value, topic_action, type in self.fetch_all(
+                "SELECT key, value, topic_action, type FROM auto_response WHERE is_regex = 1 ORDER BY id"):
+            try:
+                auto_responses.append((re.compile(key), value, topic_action, type))
+            except re.error:
+                logger.error(_("Invalid regular expression: {}").format(key))
+        return auto_responses
+
+    def list_regex_auto_responses(self) -> list:
+        return self.regex_auto_responses
+
+    def count_auto_responses(self) -> int:
+        return self.fetch_value("SELECT COUNT(*) FROM auto_response")
+
+    # Keyset pagination: seek past the last id shown instead of counting skipped rows with OFFSET
+    def list_auto_responses(self, limit: int, after: int = None, before: int = None) -> list:
+        if before is not None:
+            return self.fetch_all("SELECT id, key, value, topic_action, is_regex, type FROM auto_response "
+                                  "WHERE id < ? ORDER BY id DESC LIMIT ?", (before, limit))[::-1]
+        return self.fetch_all("SELECT id, key, value, topic_action, is_regex, type FROM auto_response "
+                              "WHERE id > ? ORDER BY id LIMIT ?", (after or 0, limit))
+
+
+class TGBot:
+    def __init__(self, bot_token: str, group_id: str, db_path: str = "./data/storage.db", num_workers: int = 4):
+        logger.info(_("Starting BetterForward..."))
+        self.group_id = int(group_id)
+        # Share one keep-alive session between the polling, handler and message worker threads
+        apihelper.session = requests.Session()
+        apihelper.session.mount("https://", HTTPAdapter(pool_connections=2,
+                                                             pool_maxsize=num_workers * 4 + BROADCAST_WORKERS))
+        # A single dispatch thread hands messages to their lanes in arrival order, the lanes do the work in parallel
+        # Commands and callbacks are handed to a pool of their own, so they never wait behind message dispatch
+        self.bot = TeleBot(token=bot_token, num_threads=1)
+        self.bot_id = self.bot.get_me().id
+        self.bot.edited_message_handler(func=lambda m: True)(self.handle_edit)
+        self.bot.message_handler(commands=["start", "help"])(self.in_control(self.help))
+        self.bot.message_handler(commands=["ban"])(self.in_control(self.ban_user))
+        self.bot.message_handler(commands=["unban"])(self.in_control(self.unban_user))
+        self.bot.message_handler(commands=["terminate"])(self.in_control(self.handle_terminate))
+        self.bot.message_handler(commands=["delete"])(self.in_control(self.delete_message))
+        self.bot.message_handler(commands=["verify"])(self.in_control(self.handle_verify))
+        self.bot.message_handler(func=lambda m: True, content_types=["photo", "text", "sticker", "video", "document"])(
+            self.push_messages)
+        self.bot.message_reaction_handler(func=lambda message: True)(self.handle_reaction)
+        self.bot.callback_query_handler(func=lambda call: True)(self.in_control(self.callback_query))
+        # Admin callback action -> (handler, required keys, optional keys)
+        self.callback_actions = {
+            "menu": (lambda message: self.menu(message, edit=True), (), ()),
+            "auto_reply": (self.auto_reply_menu, (), ()),
+            "set_auto_reply_type": (self.set_auto_reply_type, ("regex",), ()),
+            "start_add_auto_reply": (self.add_auto_response, (), ()),
+            "add_auto_reply": (self.process_add_auto_reply, (), ("topic_action",)),
+            "manage_auto_reply": (self.manage_auto_reply, (), ("page", "after", "before")),
+            "select_auto_reply": (self.select_auto_reply, ("id",), ()),
+            "delete_auto_reply": (self.delete_auto_reply, ("id",), ()),
+            "ban_user": (self.manage_ban_user, (), ("page", "after", "before")),
+            "unban_user": (self.unban_user, ("id",), ()),
+            "select_ban_user": (self.select_ban_user, ("id",), ()),
+            "default_msg": (self.default_msg_menu, (), ()),
+            "edit_default_msg": (self.edit_default_msg, (), ()),
+            "empty_default_msg": (self.empty_default_msg, (), ()),
+            "captcha_settings": (self.captcha_settings_menu, (), ()),
+            "set_captcha": (self.set_captcha, ("value",), ()),
+            "broadcast_message": (self.broadcast_message, (), ()),
+            "confirm_broadcast": (self.confirm_broadcast_message, (), ()),
+            "cancel_broadcast": (self.cancel_broadcast_message, (), ()),
+        }
+        self.database = Database(db_path)
+        self.bot.set_my_commands([
+            types.BotCommand("delete", _("Delete a message")),
+            types.BotCommand("help", _("Show help")),
+        ], scope=types.BotCommandScopeAllPrivateChats())
+        self.bot.set_my_commands([
+            types.BotCommand("help", _("Show help")),
+            types.BotCommand("ban", _("Ban a user")),
+            types.BotCommand("unban", _("Unban a user")),
+            types.BotCommand("delete", _("Delete a message")),
+            types.BotCommand("terminate", _("Terminate a thread")),
+            types.BotCommand("verify", _("Set verified status")),
+        ], scope=types.BotCommandScopeChat(self.group_id))
+        self.cache = Cache()
+        self.build_markups()
+        self.check_permission()
+        # One single-threaded worker per lane keeps the messages of a conversation in order
+        self.message_workers = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"msg_{i}")
+                                for i in range(num_workers)]
+        self.control_worker = ThreadPoolExecutor(max_workers=2, thread_name_prefix="control")
+        # Broadcasts share one pool, kept for the lifetime of the bot rather than spawned per broadcast
+        self.broadcast_executor = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix="broadcast")
+        self.broadcast_limiter = RateLimiter(BROADCAST_RATE, BROADCAST_RATE)
+        # Broadcasts run one at a time off the handler threads, so admin input is not held up by the fan-out
+        self.broadcast_jobs = ThreadPoolExecutor(max_workers=1, thread_name_prefix="broadcast_job")
+        # Set on shutdown, a running broadcast stops taking recipients and only waits for the sends already made
+        self.stopping = threading.Event()
+        try:
+            self.bot.infinity_polling(skip_pending=True, timeout=30,
+                                      allowed_updates=['message', 'edited_message', 'callback_query',
+                                                       'my_chat_member', 'message_reaction',
+                                                       'message_reaction_count', ])
+        finally:
+            # Stop every thread that may still use the database before its connections are closed
+            self.stopping.set()
+            self.bot.stop_bot()
+            self.control_worker.shutdown(wait=True)
+            for worker in self.message_workers:
+                worker.shutdown(wait=True)
+            self.broadcast_jobs.shutdown(wait=True, cancel_futures=True)
+            self.broadcast_executor.shutdown(wait=True, cancel_futures=True)
+            self.database.close()
+
+    # Static keyboards are identical on every render, so build them only once
+    def build_markups(self):
+        self.back_button = types.InlineKeyboardButton(BACK_LABEL, callback_data=CB_MENU)
+        self.back_markup = types.InlineKeyboardMarkup()
+        self.back_markup.add(self.back_button)
+        self.auto_reply_back_button = types.InlineKeyboardButton(BACK_LABEL, callback_data=CB_AUTO_REPLY)
+        self.auto_reply_back_markup = types.InlineKeyboardMarkup()
+        self.auto_reply_back_markup.add(self.auto_reply_back_button)
+        self.manage_auto_reply_back_button = types.InlineKeyboardButton(BACK_LABEL, callback_data=CB_MANAGE_AUTO_REPLY)
+        self.manage_auto_reply_back_markup = types.InlineKeyboardMarkup()
+        self.manage_auto_reply_back_markup.add(self.manage_auto_reply_back_button)
+        self.add_auto_reply_back_button = types.InlineKeyboardButton(BACK_LABEL, callback_data=CB_ADD_AUTO_REPLY)
+        self.ban_user_back_button = types.InlineKeyboardButton(BACK_LABEL, callback_data=CB_BAN_USER)
+        self.ban_user_back_markup = types.InlineKeyboardMarkup()
+        self.ban_user_back_markup.add(self.ban_user_back_button)
+        self.menu_markup = types.InlineKeyboardMarkup()
+        self.menu_markup.add(types.InlineKeyboardButton("💬" + _("Auto Reply"),
+                                                        callback_data=CB_AUTO_REPLY))
+        self.menu_markup.add(types.InlineKeyboardButton("📙" + _("Default Message"),
+                                                        callback_data=CB_DEFAULT_MSG))
+        self.menu_markup.add(types.InlineKeyboardButton("⛔" + _("Banned Users"),
+                                                        callback_data=CB_BAN_USER))
+        self.menu_markup.add(types.InlineKeyboardButton("🔒" + _("Captcha Settings"),
+                                                        callback_data=CB_CAPTCHA_SETTINGS))
+        self.menu_markup.add(types.InlineKeyboardButton("📢" + _("Broadcast Message"),
+                                                        callback_data=CB_BROADCAST_MESSAGE))
+        self.auto_reply_markup = types.InlineKeyboardMarkup()
+        self.auto_reply_markup.add(types.InlineKeyboardButton("➕" + _("Add Auto Reply"),
+                                                              callback_data=CB_START_ADD_AUTO_REPLY))
+        self.auto_reply_markup.add(types.InlineKeyboardButton("⚙️" + _("Manage Existing Auto Reply"),
+                                                              callback_data=CB_MANAGE_AUTO_REPLY))
+        self.auto_reply_markup.add(self.back_button)
+        self.auto_reply_regex_markup = types.InlineKeyboardMarkup()
+        self.auto_reply_regex_markup.add(types.InlineKeyboardButton(YES_LABEL, callback_data=CB_AUTO_REPLY_REGEX))
+        self.auto_reply_regex_markup.add(types.InlineKeyboardButton(NO_LABEL, callback_data=CB_AUTO_REPLY_PLAIN))
+        self.auto_reply_regex_markup.add(self.auto_reply_back_button)
+        self.auto_reply_forward_markup = types.InlineKeyboardMarkup()
+        self.auto_reply_forward_markup.add(types.InlineKeyboardButton(FORWARD_LABEL,
+                                                                      callback_data=CB_ADD_AUTO_REPLY_FORWARD))
+        self.auto_reply_forward_markup.add(types.InlineKeyboardButton(NO_FORWARD_LABEL,
+                                                                      callback_data=CB_ADD_AUTO_REPLY_NO_FORWARD))
+        self.auto_reply_forward_markup.add(self.add_auto_reply_back_button)
+        self.default_msg_markup = types.InlineKeyboardMarkup()
+        self.default_msg_markup.add(types.InlineKeyboardButton(EDIT_MESSAGE_LABEL, callback_data=CB_EDIT_DEFAULT_MSG))
+        self.default_msg_markup.add(types.InlineKeyboardButton(SET_TO_DEFAULT_LABEL,
+                                                               callback_data=CB_EMPTY_DEFAULT_MSG))
+        self.default_msg_markup.add(self.back_button)
+        # One captcha settings keyboard per selected option, None for when nothing is set yet
+        self.captcha_markups = {}
+        for selected in (None, *CAPTCHA_OPTIONS):
+            markup = self.captcha_markups[selected] = types.InlineKeyboardMarkup()
+            for value, name in CAPTCHA_OPTIONS.items():
+                icon = SELECTED_LABEL if selected == value else "⚪"
+                markup.add(types.InlineKeyboardButton(icon + name, callback_data=CB_SET_CAPTCHA[value]))
+            markup.add(self.back_button)
+        self.broadcast_markup = types.InlineKeyboardMarkup()
+        self.broadcast_markup.add(types.InlineKeyboardButton(CONFIRM_LABEL, callback_data=CB_CONFIRM_BROADCAST))
+        self.broadcast_markup.add(types.InlineKeyboardButton(CANCEL_LABEL, callback_data=CB_CANCEL_BROADCAST))
+
+    def check_valid_chat(self, message: Message):
+        return message.chat.id == self.group_id and message.message_thread_id is None
+
+    @staticmethod
+    def is_cancel(message: Message) -> bool:
+        return isinstance(message.text, str) and CANCEL_RE.match(message.text) is not None
+
+    # Why a regex trigger is refused, None when it can be used
+    @staticmethod
+    def regex_error(pattern: str) -> str | None:
+        if NESTED_QUANTIFIER_RE.search(pattern):
+            return _("Refused: repeating a group that contains a repetition, such as (a+)+, can make matching very "
+                     "slow. This is only a rough check, so some safe expressions are refused as well.")
+        try:
+            re.compile(pattern)
+        except re.error:
+            return _("Invalid regular expression")
+        return None
+
+    def generate_captcha(self, user_id: int, type="math"):
+        match type:
+            case "math":
+                num1 = random.randint(1, 10)
+                num2 = random.randint(1, 10)
+                answer = num1 + num2
+                self.cache.set(f"captcha_{user_id}", answer, 300)
+                return f"{num1} + {num2} = ?"
+            case "button":
+                markup = types.InlineKeyboardMarkup()
+                markup.add(types.InlineKeyboardButton(
+                    "Click to verify", callback_data=f"verify_button:{user_id}"))
+                self.bot.send_message(user_id, _("Please click the button to verify."), reply_markup=markup)
+            case _:
+                raise ValueError(_("Invalid captcha setting"))
+
+    def handle_button_captcha(self, call: types.CallbackQuery, user_id: int = None):
+        if user_id:
+            self.cache.set(f"verified_{user_id}", True, 1800)  # 设置用户为已验证
+            self.bot.answer_callback_query(call.id)
+            # Replace the captcha with the result, which also removes its button
+            self.bot.edit_message_text(_("Verification successful, you can now send messages"),
+                                       call.message.chat.id, call.message.message_id)
+            self.database.set_verified(user_id)
+        else:
+            self.bot.answer_callback_query(call.id)
+            self.bot.send_message(call.message.chat.id, _("Invalid user ID"))
+
+    # Get thread_id to terminate when needed
+    def terminate_thread(self, thread_id=None, user_id=None):
+        if thread_id is not None:
+            user_id = self.database.get_user_id(thread_id)
+        elif user_id is not None:
+            if (thread_id := self.database.get_thread_id(user_id)) is None:
+                raise ValueError(_("User not found"))
+        self.database.delete_topic(thread_id)
+        self.cache.delete(f"chat_{user_id}_threadid")
+        self.cache.delete(f"threadid_{thread_id}_userid")
+        try:
+            delete_forum_topic(chat_id=self.group_id, message_thread_id=thread_id, token=self.bot.token)
+        except ApiTelegramException:
+            pass
+        logger.info(_("Terminating thread") + str(thread_id))
+
+    # To terminate and totally delete the topic
+    def handle_terminate(self, message: Message):
+        if message.chat.id == self.group_id:
+            user_id = None
+            thread_id = None
+            if message.message_thread_id is None:
+                if len((msg_split := message.text.split(" "))) != 2:
+                    self.bot.reply_to(message, "Invalid command\n"
+                                               "Correct usage:```\n"
+                                               "/terminate <user ID>```", parse_mode="Markdown")
+                    return
+                user_id = int(msg_split[1])
+            else:
+                thread_id = message.message_thread_id
+            if thread_id == 1:
+                self.bot.reply_to(message, _("Cannot terminate main thread"))
+                return
+            try:
+                self.terminate_thread(thread_id=thread_id, user_id=user_id)
+                if message.message_thread_id is None:
+                    self.bot.reply_to(message, _("Thread terminated"))
+            except Exception:
+                logger.error(_("Failed to terminate the thread") + str(thread_id))
+                self.bot.reply_to(message, _("Failed to terminate the thread"))
+        else:
+            self.bot.send_message(message.chat.id, _("This command is only available to admin users."))
+
+    def match_auto_response(self, text):
+        if text is None:
+            return None
+        # Check for exact match
+        if (result := self.database.find_auto_response(text)) is not None:
+            return {"response": result[0], "topic_action": result[1], "type": result[2]}
+
+        # Check for regex
+        for pattern, value, topic_action, type in self.database.list_regex_auto_responses():
+            if pattern.match(text):
+                return {"response": value, "topic_action": topic_action, "type": type}
+        return None
+
+    # Create a forum topic, retrying rate limits and connection failures
+    def create_topic(self, name: str):
+        return call_with_retry(create_forum_topic, chat_id=self.group_id, name=name, token=self.bot.token)
+
+    # Run a command or callback handler on the control pool
+    def in_control(self, handler):
+        return lambda update: self.control_worker.submit(self.run_control, handler, update)
+
+    def run_control(self, handler, update):
+        try:
+            handler(update)
+        except Exception as e:
+            logger.exception(_("Failed to process message: {}").format(e))
+
+    # Hand messages to the worker of their conversation, never blocking the dispatch thread
+    def push_messages(self, message: Message):
+        conversation = message.chat.id if message.chat.id != self.group_id else message.message_thread_id
+        worker = self.message_workers[hash(conversation) % len(self.message_workers)]
+        worker.submit(self.process_message, message)
+
+    # Main message handler
+    def handle_message(self, message: Message, retry=False):
+        # Not responding in General topic
+        if self.check_valid_chat(message):
+            return
+        if message.chat.id != self.group_id:
+            logger.info(
+                _("Received message from {}, content: {}, type: {}").format(message.from_user.id, message.text,
+                                                                            message.content_type))
+            captcha_setting = self.database.get_setting(SettingKey.CAPTCHA)
+            if captcha_setting != "disable":
+                # Captcha Handler
+                if (captcha := self.cache.get(f"captcha_{message.from_user.id}")) is not None:
+                    if message.text != str(captcha):
+                        logger.info(_("User {} entered an incorrect answer").format(message.from_user.id))
+                        self.bot.send_message(message.chat.id, _("The answer is incorrect, please try again"))
+                        return
+                    logger.info(_("User {} passed the captcha").format(message.from_user.id))
+                    self.bot.send_message(message.chat.id, _("Verification successful, you can now send messages"))
+                    self.database.set_verified(message.from_user.id)
+                    self.cache.delete(f"captcha_{message.from_user.id}")
+                    self.cache.set(f"verified_{message.from_user.id}", True, 1800)
+                    return
+
+                # Check if the user is verified
+                verified = self.cache.get(f"verified_{message.from_user.id}")
+                if verified is None:
+                    verified = self.database.is_verified(message.from_user.id)
+
+                if not verified:
+                    logger.info(_("User {} is not verified").format(message.from_user.id))
+                    match captcha_setting:
+                        case "button":
+                            self.generate_captcha(message.from_user.id, captcha_setting)
+                            return
+                        case "math":
+                            captcha = self.generate_captcha(message.from_user.id, captcha_setting)
+                            self.bot.send_message(message.chat.id,
+                                                  _("Captcha is enabled. Please solve the following question and send the result directly\n") + captcha)
+                            return
+                        case _:
+                            logger.error(_("Invalid captcha setting"))
+                            self.bot.send_message(self.group_id,
+                                                  _("Invalid captcha setting") + f": {captcha_setting}")
+                            return
+                else:
+                    self.cache.set(f"verified_{message.from_user.id}", verified, 1800)
+
+            # Check if the user is banned
+            if self.database.is_banned(message.from_user.id):
+                logger.info(_("User {} is banned").format(message.from_user.id))
+                return
+            # Auto response
+            topic_action = False
+            auto_response = None
+            if (auto_response_result := self.match_auto_response(message.text)) is not None:
+                if not retry:
+                    match auto_response_result["type"]:
+                        case "text":
+                            self.bot.send_message(message.chat.id,
+                                                  auto_response_result["response"])
+                        case "photo":
+                            self.bot.send_photo(message.chat.id,
+                                                photo=auto_response_result["response"])
+                        case "sticker":
+                            self.bot.send_sticker(message.chat.id,
+                                                  sticker=auto_response_result["response"])
+                        case "video":
+                            self.bot.send_video(message.chat.id,
+                                                video=auto_response_result["response"])
+                        case "document":
+                            self.bot.send_document(message.chat.id,
+                                                   document=auto_response_result["response"])
+                        case _:
+                            logger.error(_("Unsupported message type") + auto_response_result["type"])
+                if auto_response_result["topic_action"]:
+                    topic_action = True
+                    auto_response = auto_response_result["response"]
+                else:
+                    return
+            # Forward message to group
+            userid = message.from_user.id
+            if (thread_id := self.cache.get(f"chat_{userid}_threadid")) is None:
+                if (thread_id := self.database.get_thread_id(userid)) is None:
+                    # Create a new thread
+                    logger.info(_("Creating a new thread for user {}").format(userid))
+                    try:
+                        topic = self.create_topic(message.from_user.first_name)
+                    except (ApiTelegramException, requests.RequestException) as e:
+                        logger.error(e)
+                        return
+                    # Persist the topic before anything else can fail, so it is never created twice
+                    self.database.add_topic(userid, topic["message_thread_id"])
+                    thread_id = topic["message_thread_id"]
+                    self.cache.set(f"chat_{userid}_threadid", thread_id)
+                    username = _(
+                        "Not set") if message.from_user.username is None else f"@{message.from_user.username}"
+                    last_name = "" if message.from_user.last_name is None else f" {message.from_user.last_name}"
+                    # The topic is usable without the pinned user info, so only log failures here
+                    try:
+                        pin_message = self.bot.send_message(
+                            self.group_id,
+                            f"User ID: [{userid}](tg://openmessage?user_id={userid})\n"
+                            f"Full Name: {escape_markdown(f"{message.from_user.first_name}{last_name}")}\n"
+                            f"Username: {escape_markdown(username)}\n",
+                            message_thread_id=thread_id, parse_mode='markdown')
+                        self.bot.pin_chat_message(self.group_id, pin_message.message_id)
+                    except ApiTelegramException as e:
+                        logger.error(e)
+                else:
+                    self.cache.set(f"chat_{userid}_threadid", thread_id)
+            try:
+                reply_id = None
+                if message.reply_to_message is not None:
+                    if message.reply_to_message.from_user.id == message.from_user.id:
+                        result = self.database.get_forwarded_id(message.reply_to_message.message_id, thread_id, False)
+                    else:
+                        result = self.database.get_received_id(message.reply_to_message.message_id, thread_id, True)
+                    if result is not None:
+                        reply_id = int(result)
+                match message.content_type:
+                    case "photo":
+                        fwd_msg = self.bot.send_photo(chat_id=self.group_id,
+                                                      photo=message.photo[-1].file_id,
+                                                      caption=message.caption,
+                                                      message_thread_id=thread_id,
+                                                      reply_to_message_id=reply_id)
+                    case "text":
+                        fwd_msg = self.bot.send_message(chat_id=self.group_id,
+                                                        text=message.text,
+                                                        message_thread_id=thread_id,
+                                                        reply_to_message_id=reply_id)
+                    case "sticker":
+                        fwd_msg = self.bot.send_sticker(chat_id=self.group_id,
+                                                        sticker=message.sticker.file_id,
+                                                        message_thread_id=thread_id,
+                                                        reply_to_message_id=reply_id)
+                    case "video":
+                        fwd_msg = self.bot.send_video(chat_id=self.group_id,
+                                                      video=message.video.file_id,
+                                                      caption=message.caption,
+                                                      message_thread_id=thread_id,
+                                                      reply_to_message_id=reply_id)
+                    case "document":
+                        fwd_msg = self.bot.send_document(chat_id=self.group_id,
+                                                         document=message.document.file_id,
+                                                         caption=message.caption,
+                                                         message_thread_id=thread_id,
+                                                         reply_to_message_id=reply_id)
+                    case _:
+                        logger.error(_("Unsupported message type") + message.content_type)
+                        return
+                self.database.add_message(message.message_id, fwd_msg.message_id, thread_id, False)
+            except ApiTelegramException as e:
+                if not retry:
+                    self.terminate_thread(thread_id=thread_id)
+                    return self.handle_message(message, retry=True)
+                else:
+                    logger.error(_("Failed to forward message from user {}".format(message.from_user.id)))
+                    logger.error(e)
+                    self.bot.send_message(self.group_id,
+                                          _("Failed to forward message from user {}".format(message.from_user.id)),
+                                          message_thread_id=None)
+                    self.bot.forward_message(self.group_id, message.chat.id, message_id=message.message_id)
+                    return
+            if topic_action:
+                self.bot.send_message(self.group_id, _("[Auto Response]") + auto_response,
+                                      message_thread_id=thread_id)
+        else:
+            # Forward message to user
+            if (user_id := self.cache.get(f"threadid_{message.message_thread_id}_userid")) is None:
+                user_id = self.database.get_user_id(message.message_thread_id)
+                self.cache.set(f"threadid_{message.message_thread_id}_userid", user_id)
+            if user_id is not None:
+                reply_id = None
+                if message.reply_to_message is not None:
+                    if message.reply_to_message.from_user.id == message.from_user.id:
+                        result = self.database.get_forwarded_id(message.reply_to_message.message_id,
+                                                                message.message_thread_id, True)
+                    else:
+                        result = self.database.get_received_id(message.reply_to_message.message_id,
+                                                               message.message_thread_id, False)
+                    if result is not None:
+                        reply_id = int(result)
+                match message.content_type:
+                    case "photo":
+                        fwd_msg = self.bot.send_photo(chat_id=user_id,
+                                                      photo=message.photo[-1].file_id,
+                                                      caption=message.caption,
+                                                      reply_to_message_id=reply_id)
+                    case "text":
+                        fwd_msg = self.bot.send_message(chat_id=user_id,
+                                                        text=message.text,
+                                                        reply_to_message_id=reply_id)
+                    case "sticker":
+                        fwd_msg = self.bot.send_sticker(chat_id=user_id,
+                                                        sticker=message.sticker.file_id,
+                                                        reply_to_message_id=reply_id)
+                    case "video":
+                        fwd_msg = self.bot.send_video(chat_id=user_id,
+                                                      video=message.video.file_id,
+                                                      caption=message.caption,
+                                                      reply_to_message_id=reply_id)
+                    case "document":
+                        fwd_msg = self.bot.send_document(chat_id=user_id,
+                                                         document=message.document.file_id,
+                                                         caption=message.caption,
+                                                         reply_to_message_id=reply_id)
+                    case _:
+                        logger.error(_("Unsupported message type") + message.content_type)
+                        return
+                self.database.add_message(message.message_id, fwd_msg.message_id, message.message_thread_id, True)
+            else:
+                self.bot.send_message(self.group_id, _("Chat not found, please remove this topic manually"),
+                                      message_thread_id=message.message_thread_id)
+                close_forum_topic(chat_id=self.group_id, message_thread_id=message.message_thread_id,
+                                  token=self.bot.token)
+
+    # Process a message on its worker
+    def process_message(self, message: Message):
+        try:
+            self.handle_message(message)
+        except Exception as e:
+            logger.error(_("Failed to process message: {}").format(e))
+
+    def check_permission(self):
+        # Both lookups are independent, so fetch them concurrently
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            chat_future = executor.submit(self.bot.get_chat, self.group_id)
+            chat_member_future = executor.submit(self.bot.get_chat_member, self.group_id, self.bot_id)
+            chat = chat_future.result()
+            chat_member = chat_member_future.result()
+        if not chat.is_forum:
+            logger.error(_("Topic function is not enabled in this group"))
+            self.bot.send_message(self.group_id, _("Topic function is not enabled in this group"))
+        missing_template = _("Bot doesn't have {} permission")
+        for attribute, name in REQUIRED_PERMISSIONS:
+            if getattr(chat_member, attribute) is False:
+                logger.error(missing_template.format(name))
+                self.bot.send_message(self.group_id, missing_template.format(name))
+        self.bot.send_message(self.group_id, _("Bot started successfully"))
+
+    # Only resend the keyboard when the menu text is unchanged, Telegram stores the text without trailing whitespace
+    def edit_menu(self, message: Message, text: str, markup: types.InlineKeyboardMarkup):
+        try:
+            if message.text == text.rstrip():
+                self.bot.edit_message_reply_markup(message.chat.id, message.message_id, reply_markup=markup)
+            else:
+                self.bot.edit_message_text(text, message.chat.id, message.message_id, reply_markup=markup)
+        except ApiTelegramException as e:
+            # Pressing the same button twice leaves nothing to change
+            if "message is not modified" not in e.description:
+                raise
+
+    # Replace a menu with a short status line and a single Back button, to the main menu unless given
+    def reply_with_back(self, message: Message, text: str, markup: types.InlineKeyboardMarkup = None):
+        self.bot.edit_message_text(text, message.chat.id, message.message_id, reply_markup=markup or self.back_markup)
+
+    def auto_reply_menu(self, message: Message):
+        self.edit_menu(message, _("Auto Reply"), self.auto_reply_markup)
+
+    def add_auto_response(self, message: Message):
+        if not self.check_valid_chat(message):
+            return
+        msg = self.bot.edit_message_text(text=_(
+            "Let's set up an automatic response.\nSend /cancel to cancel this operation.\n\n"
+            "Please send the keywords or regular expression that should trigger this response."),
+            chat_id=self.group_id, message_id=message.message_id)
+        self.bot.register_next_step_handler(msg, self.add_auto_response_type)
+
+    def add_auto_response_type(self, message: Message):
+        # 选择是否是正则表达式
+        if not self.check_valid_chat(message):
+            return
+        if self.is_cancel(message):
+            self.bot.send_message(self.group_id, _("Operation cancelled"))
+            return
+        if message.content_type != "text" or not message.text or len(message.text) > MAX_TRIGGER_LENGTH:
+            self.bot.send_message(self.group_id, _("Invalid input"))
+            return
+        # The auto reply being added is kept as a single draft entry for the whole flow
+        self.cache.set("auto_response_draft", {"key": message.text}, 300)
+        help_text = _("Trigger: {}").format(message.text) + "\n\n" + _("Is this a regular expression?")
+        self.bot.send_message(text=help_text, chat_id=self.group_id, reply_markup=self.auto_reply_regex_markup)
+
+    def set_auto_reply_type(self, message: Message, regex: bool):
+        draft = self.cache.get("auto_response_draft")
+        # Validate the trigger itself, once, when it is marked as a regular expression
+        if regex and draft is not None and (error := self.regex_error(draft["key"])) is not None:
+            self.reply_with_back(message, error, self.auto_reply_back_markup)
+            return
+        if draft is not None:
+            draft["regex"] = regex
+            self.cache.set("auto_response_draft", draft, 300)
+        self.add_auto_response_value(message)
+
+    def add_auto_response_value(self, message: Message):
+        if not self.check_valid_chat(message):
+            return
+        if self.is_cancel(message):
+            self.bot.send_message(self.group_id, _("Operation cancelled"))
+            return
+        msg = self.bot.edit_message_text(text=_("Please send the response content. It can be text, stickers, photos "
+                                                "and so on."),
+                                         chat_id=self.group_id, message_id=message.message_id)
+        self.bot.register_next_step_handler(msg, self.add_auto_response_topic_action)
+
+    def add_auto_response_topic_action(self, message: Message):
+        if not self.check_valid_chat(message):
+            return
+        if self.is_cancel(message):
+            self.bot.send_message(self.group_id, _("Operation cancelled"))
+            self.cache.delete("auto_response_draft")
+            return
+        if (draft := self.cache.get("auto_response_draft")) is None:
+            self.bot.send_message(self.group_id, _("The operation has timed out. Please initiate the process again."))
+            return
+        if (get_content := MESSAGE_CONTENT.get(message.content_type)) is None:
+            self.bot.send_message(self.group_id, _("Unsupported message type"))
+            return
+        draft["value"] = get_content(message)
+        draft["type"] = message.content_type
+        self.cache.set("auto_response_draft", draft, 300)
+        help_text = "\n".join((
+            _("Trigger: {}").format(draft["key"]),
+            _("Response: {}").format(draft["value"] if draft["type"] == "text" else draft["type"]),
+            _("Is regex: {}").format("✅" if draft.get("regex") else "❌"),
+            "",
+            _("Do you want to forward the message to the user?")))
+        self.bot.send_message(self.group_id, help_text,
+                              reply_markup=self.auto_reply_forward_markup,
+                              message_thread_id=None)
+
+    def process_add_auto_reply(self, message: Message, topic_action: bool = None):
+        draft = self.cache.pop("auto_response_draft") or {}
+        key = draft.get("key")
+        value = draft.get("value")
+        is_regex = draft.get("regex")
+        type = draft.get("type")
+        if None in [topic_action, key, value, is_regex, type]:
+            self.bot.edit_message_text(_("Invalid action"), self.group_id, message.message_id,
+                                       reply_markup=types.InlineKeyboardMarkup())
+            return
+        self.database.add_auto_response(key, value, topic_action, is_regex, type)
+        self.reply_with_back(message, _("Auto reply added"))
+
+    def menu(self, message, edit=False):
+        if not self.check_valid_chat(message):
+            return
+        if edit:
+            self.edit_menu(message, MENU_TEXT, self.menu_markup)
+        else:
+            self.bot.send_message(self.group_id, MENU_TEXT, reply_markup=self.menu_markup, message_thread_id=None)
+
+    def help(self, message: Message):
+        if self.check_valid_chat(message):
+            self.menu(message)
+        else:
+            if (response := self.database.get_setting(SettingKey.DEFAULT_MESSAGE)) is None:
+                self.bot.send_message(message.chat.id, _("I'm a bot that forwards messages, so please just tell me "
+                                                         "what you want to say.") + "\n" +
+                                      "Powered by [BetterForward](https://github.com/SideCloudGroup/BetterForward)",
+                                      parse_mode="Markdown",
+                                      disable_web_page_preview=True)
+            else:
+                self.bot.send_message(message.chat.id, response)
+
+    # When the first and last ids of the page are given, they are passed on as keyset cursors,
+    # for actions taking the optional keys (page, after, before)
+    @staticmethod
+    def add_page_buttons(markup: types.InlineKeyboardMarkup, action: str, page: int, total_pages: int,
+                         first_id: int = None, last_id: int = None):
+        buttons = []
+        if page > 1:
+            cursor = "" if first_id is None else f"::{first_id}"
+            buttons.append(types.InlineKeyboardButton(
+                PREVIOUS_PAGE_LABEL, callback_data=f"{action}:{page - 1}{cursor}"))
+        if page < total_pages:
+            cursor = "" if last_id is None else f":{last_id}"
+            buttons.append(types.InlineKeyboardButton(
+                NEXT_PAGE_LABEL, callback_data=f"{action}:{page + 1}{cursor}"))
+        if buttons:
+            markup.row(*buttons)
+
+    def manage_auto_reply(self, message: Message, page: int = 1, after: int = None, before: int = None,
+                          page_size: int = 5):
+        # Calculate pagination
+        total_responses = self.database.count_auto_responses()
+        if total_responses == 0:
+            self.edit_menu(message, AUTO_REPLY_LIST_HEADER.format(0), self.auto_reply_back_markup)
+            return
+        total_pages = (total_responses + page_size - 1) // page_size
+
+        # Fetch data with limits, starting over if the page emptied since the buttons were sent
+        if (after is None and before is None) or total_pages == 1:
+            page, after, before = 1, None, None
+        auto_responses = self.database.list_auto_responses(page_size, after, before)
+        if not auto_responses and page > 1:
+            page = 1
+            auto_responses = self.database.list_auto_responses(page_size)
+
+        parts = [AUTO_REPLY_LIST_HEADER.format(total_responses), PAGE_LINE.format(page, total_pages), "\n\n"]
+        id_buttons = []
+        for auto_response in auto_responses:
+            parts.append(AUTO_REPLY_ENTRY.format(
+                auto_response[0], auto_response[1],
+                auto_response[2] if auto_response[5] == "text" else auto_response[5],
+                "✅" if auto_response[3] else "❌", "✅" if auto_response[4] else "❌"))
+            id_buttons.append(types.InlineKeyboardButton(
+                text=auto_response[0], callback_data=f"select_auto_reply:{auto_response[0]}"))
+
+        # Add ID buttons in a single row
+        markup = types.InlineKeyboardMarkup()
+        if id_buttons:
+            markup.row(*id_buttons)
+
+        # Add pagination buttons
+        if total_pages > 1 and auto_responses:
+            self.add_page_buttons(markup, "manage_auto_reply", page, total_pages,
+                                  auto_responses[0][0], auto_responses[-1][0])
+
+        # Add back button in a separate row
+        markup.add(self.auto_reply_back_button)
+        self.edit_menu(message, "".join(parts), markup)
+
+    def select_auto_reply(self, message: Message, id: int):
+        if (auto_response := self.database.get_auto_response(id)) is None:
+            self.reply_with_back(message, _("Auto reply not found"), self.manage_auto_reply_back_markup)
+            return
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton(DELETE_LABEL,
+                                              callback_data=f"delete_auto_reply:{id}"))
+        markup.add(self.manage_auto_reply_back_button)
+        text = AUTO_REPLY_DETAILS.format(
+            auto_response[0], auto_response[1] if auto_response[4] == "text" else auto_response[4],
+            "✅" if auto_response[2] else "❌", "✅" if auto_response[3] else "❌")
+        self.edit_menu(message, text, markup)
+
+    def delete_auto_reply(self, message: Message, id: int):
+        self.database.delete_auto_response(id)
+        self.reply_with_back(message, _("Auto reply deleted"), self.manage_auto_reply_back_markup)
+
+    def ban_user(self, message: Message):
+        if message.chat.id == self.group_id and message.message_thread_id is None:
+            self.bot.send_message(self.group_id, _("This command is not available in the main chat."))
+            return
+        if message.chat.id != self.group_id:
+            self.bot.send_message(message.chat.id, _("This command is only available to admin users."))
+            return
+        self.database.ban_thread(message.message_thread_id)
+        self.bot.send_message(self.group_id, _("User banned"), message_thread_id=message.message_thread_id)
+        close_forum_topic(chat_id=self.group_id, message_thread_id=message.message_thread_id, token=self.bot.token)
+
+    def unban_user(self, message: Message, user_id: int = None):
+        if message.chat.id != self.group_id:
+            self.bot.send_message(message.chat.id, _("This command is only available to admin users."))
+            return
+        if user_id is None:
+            if self.check_valid_chat(message):
+                if len((msg_split := message.text.split(" "))) != 2:
+                    self.bot.reply_to(message, "Invalid command\n"
+                                               "Correct usage:```\n"
+                                               "/unban <user ID>```", parse_mode="Markdown")
+                    return
+                user_id = int(msg_split[1])
+        if user_id is None:
+            self.database.unban_thread(message.message_thread_id)
+            self.bot.send_message(self.group_id, _("User unbanned"), message_thread_id=message.message_thread_id)
+            try:
+                reopen_forum_topic(chat_id=self.group_id, message_thread_id=message.message_thread_id,
+                                   token=self.bot.token)
+            except ApiTelegramException:
+                pass
+        else:
+            # Check user exists
+            if (thread_id := self.database.get_thread_id(user_id)) is None:
+                self.bot.send_message(self.group_id, _("User not found"))
+                return
+            self.database.unban_user(user_id)
+            # Only talk to Telegram once the write has been committed
+            try:
+                reopen_forum_topic(chat_id=self.group_id, message_thread_id=thread_id,
+                                   token=self.bot.token)
+            except ApiTelegramException:
+                pass
+            if message.from_user.id == self.bot_id:
+                self.reply_with_back(message, _("User unbanned"))
+            else:
+                self.bot.send_message(self.group_id, _("User unbanned"), reply_markup=self.back_markup)
+
+    def manage_ban_user(self, message: Message, page: int = 1, after: int = None, before: int = None,
+                        page_size: int = 10):
+        if after is None and before is None:
+            page = 1
+        banned, total_banned = self.database.page_banned(page_size, after, before)
+        # The page may have emptied since it was rendered, start over from the first one
+        if not banned and page > 1:
+            page = 1
+            banned, total_banned = self.database.page_banned(page_size)
+        if total_banned == 0:
+            self.edit_menu(message, BANNED_LIST_HEADER.format(0), self.back_markup)
+            return
+        total_pages = (total_banned + page_size - 1) // page_size
+
+        markup = types.InlineKeyboardMarkup()
+
+        parts = [BANNED_LIST_HEADER.format(total_banned) + PAGE_LINE.format(page, total_pages)]
+        for user_id in banned:
+            parts.append(DIVIDER)
+            parts.append(f"User ID: {user_id}")
+            markup.add(types.InlineKeyboardButton(
+                text=user_id, callback_data=f"select_ban_user:{user_id}"))
+
+        # Add pagination buttons
+        if total_pages > 1:
+            self.add_page_buttons(markup, "ban_user", page, total_pages, banned[0], banned[-1])
+
+        markup.add(self.back_button)
+        self.edit_menu(message, "\n".join(parts) + "\n", markup)
+
+    def select_ban_user(self, message: Message, id: int):
+        if self.database.get_thread_id(id) is None:
+            self.reply_with_back(message, _("User not found"), self.ban_user_back_markup)
+            return
+        markup = types.InlineKeyboardMarkup()
+        markup.add(types.InlineKeyboardButton(UNBAN_LABEL,
+                                              callback_data=f"unban_user:{id}"))
+        markup.add(self.ban_user_back_button)
+        self.edit_menu(message, f"User ID: {id}", markup)
+
+    def default_msg_menu(self, message: Message):
+        if not self.check_valid_chat(message):
+            return
+        self.edit_menu(message, _("Default Message") + "\n" +
+                       _("The default message is an auto-reply to the commands /help and /start"),
+                       self.default_msg_markup)
+
+    def empty_default_msg(self, message: Message):
+        self.database.set_setting(SettingKey.DEFAULT_MESSAGE, None)
+        self.reply_with_back(message, _("Default message has been restored."))
+
+    def edit_default_msg(self, message: Message):
+        msg = self.bot.edit_message_text(text=_(
+            "Let's set up the default message.\nSend /cancel to cancel this operation.\n\n"
+            "Please send me the response."),
+            chat_id=self.group_id, message_id=message.message_id)
+        self.bot.register_next_step_handler(msg, self.edit_default_msg_handle)
+
+    def edit_default_msg_handle(self, message: Message):
+        if not isinstance(message.text, str):
+            self.bot.send_message(self.group_id, _("Invalid input"))
+            return
+        if self.is_cancel(message):
+            self.bot.send_message(self.group_id, _("Operation cancelled"))
+            return
+        self.database.set_setting(SettingKey.DEFAULT_MESSAGE, message.text)
+        self.bot.send_message(self.group_id, _("Default message has been updated."), reply_markup=self.back_markup)
+
+    def callback_query(self, call: types.CallbackQuery):
+        # No buttons are sent to user topics, so drop those before doing any parsing
+        if call.message.chat.id == self.group_id and call.message.message_thread_id is not None:
+            return
+        if not call.data or call.data == "null":
+            logger.error(_("Invalid callback data received"))
+            return
+        try:
+            action, args = parse_callback_data(call.data)
+        except (json.JSONDecodeError, KeyError):
+            logger.error(_("Invalid JSON data received"))
+            return
+
+        # User end
+        if call.message.chat.id != self.group_id:
+            if action == "verify_button":
+                self.handle_button_captcha(call, callback_args(args, ("user_id",)).get("user_id"))
+            return
+
+        # Admin end
+        if (callback_action := self.callback_actions.get(action)) is None:
+            logger.error(_("Invalid action received") + action)
+            return
+        handler, required_keys, optional_keys = callback_action
+        data = callback_args(args, required_keys + optional_keys)
+        if any(key not in data for key in required_keys):
+            self.bot.edit_message_text(_("Invalid action"), self.group_id, call.message.message_id,
+                                       reply_markup=types.InlineKeyboardMarkup())
+            return
+        handler(call.message, *(data[key] for key in required_keys),
+                **{key: data[key] for key in optional_keys if key in data})
+
+    def captcha_settings_menu(self, message: Message):
+        if not self.check_valid_chat(message):
+            return
+        markup = self.captcha_markups.get(self.database.get_setting(SettingKey.CAPTCHA), self.captcha_markups[None])
+        self.edit_menu(message, _("Captcha Settings") + "\n", markup)
+
+    def set_captcha(self, message: Message, value: str):
+        self.database.set_setting(SettingKey.CAPTCHA, value)
+        self.reply_with_back(message, _("Captcha settings updated"))
+
+    def handle_edit(self, message: Message):
+        if self.check_valid_chat(message):
+            return
+        if (result := self.database.find_by_received(message.message_id, message.chat.id == self.group_id)) is None:
+            return
+        topic_id, forwarded_id = result
+        if message.chat.id == self.group_id:
+            if (user_id := self.database.get_user_id(topic_id)) is None:
+                return
+            match message.content_type:
+                case "text":
+                    self.bot.edit_message_text(chat_id=user_id, message_id=forwarded_id, text=message.text)
+        else:
+            match message.content_type:
+                case "text":
+                    self.bot.edit_message_text(chat_id=self.group_id, message_id=forwarded_id,
+                                               text=message.text + "\n\n" + _("(edited)"))
+
+    def delete_message(self, message: Message):
+        if self.check_valid_chat(message):
+            return
+        if message.reply_to_message is None:
+            self.bot.reply_to(message, _("Please reply to the message you want to delete"))
+            return
+        msg_id = message.reply_to_message.message_id
+        if (result := self.database.find_by_received(msg_id, message.chat.id == self.group_id)) is None:
+            return
+        topic_id, forwarded_id = result
+        if message.chat.id == self.group_id:
+            if (user_id := self.database.get_user_id(topic_id)) is None:
+                return
+            self.bot.delete_message(chat_id=user_id, message_id=forwarded_id)
+        else:
+            self.bot.delete_message(chat_id=self.group_id, message_id=forwarded_id)
+
+        # Delete the message from the database
+        self.database.delete_message(msg_id, message.chat.id == self.group_id)
+
+        # Delete the current message
+        self.bot.delete_message(chat_id=message.chat.id, message_id=message.reply_to_message.id)
+        self.bot.delete_message(chat_id=message.chat.id, message_id=message.message_id)
+
+    def broadcast_message(self, message: Message):
+        if not self.check_valid_chat(message):
+            return
+        msg = self.bot.edit_message_text(text=_(
+            "Please send the content you want to broadcast.\nSend /cancel to cancel this operation."),
+            chat_id=self.group_id, message_id=message.message_id)
+        self.bot.register_next_step_handler(msg, self.handle_broadcast_message)
+
+    def handle_broadcast_message(self, message: Message):
+        if self.is_cancel(message) or not self.check_valid_chat(message):
+            self.bot.send_message(self.group_id, _("Operation cancelled"))
+            return
+
+        if message.content_type not in MESSAGE_CONTENT:
+            self.bot.send_message(self.group_id, _("Unsupported message type"))
+            return
+
+        # The message itself is the broadcast source, it is copied to every user as-is
+        self.cache.set("broadcast_message_id", message.message_id, 300)
+
+        # Send preview message with confirmation button
+        self.bot.copy_message(self.group_id, self.group_id, message.message_id, reply_markup=self.broadcast_markup)
+
+    def confirm_broadcast_message(self, message: Message):
+        self.bot.delete_message(self.group_id, message.message_id)
+        if (source_id := self.cache.get("broadcast_message_id")) is None:
+            self.bot.send_message(self.group_id, _("The operation has timed out. Please initiate the process again."))
+            return
+
+        self.cache.delete("broadcast_message_id")
+        self.broadcast_jobs.submit(self.run_broadcast, source_id)
+
+    # The job runs detached from the handler, so anything unexpected is logged and reported here rather than lost
+    def run_broadcast(self, source_id: int):
+        try:
+            self.deliver_broadcast(source_id)
+        except Exception as e:
+            logger.exception(_("Broadcast failed: {}").format(e))
+            self.bot.send_message(self.group_id, _("Broadcast failed: {}").format(e))
+
+    def deliver_broadcast(self, source_id: int):
+        # Translated once, the same template is used for every failure and the final report
+        failed_template = _("Failed to send message to user {}")
+        failed = []
+        blocked = []
+        # Only a bounded number of sends is queued, the next recipients are read from the cursor as slots free up
+        pending = threading.BoundedSemaphore(BROADCAST_PENDING)
+
+        def collect(user_id: int, future):
+            try:
+                future.result()
+            except ApiTelegramException as e:
+                failed.append(user_id)
+                # 403 means the user blocked the bot or deleted their account, so later broadcasts skip them
+                if e.error_code == 403:
+                    blocked.append(user_id)
+                logger.error(failed_template.format(user_id))
+            except requests.ReadTimeout:
+                # Not retried, since Telegram may have delivered the copy before the response was lost
+                failed.append(user_id)
+                logger.warning(
+                    _("No response when sending to user {}, the message may have been delivered").format(user_id))
+            except requests.RequestException:
+                failed.append(user_id)
+                logger.error(failed_template.format(user_id))
+            except Exception:
+                failed.append(user_id)
+                logger.exception(failed_template.format(user_id))
+            finally:
+                pending.release()
+
+        try:
+            for user_id in self.database.iter_broadcast_recipients():
+                if self.stopping.is_set():
+                    break
+                pending.acquire()
+                future = self.broadcast_executor.submit(self.send_broadcast, user_id, source_id)
+                future.add_done_callback(lambda future, user_id=user_id: collect(user_id, future))
+        finally:
+            # Taking back every slot waits for the sends still in flight, even when reading recipients failed
+            for slot in range(BROADCAST_PENDING):
+                pending.acquire()
+            if blocked:
+                self.database.mark_blocked(blocked)
+
+        # Report all failures in one message, so a partial outage does not flood the group
+        if failed:
+            failed.sort()
+            failed_ids = ", ".join(map(str, failed[:BROADCAST_FAILURE_PREVIEW]))
+            if len(failed) > BROADCAST_FAILURE_PREVIEW:
+                failed_ids += f" ... (+{len(failed) - BROADCAST_FAILURE_PREVIEW})"
+            self.bot.send_message(self.group_id, failed_template.format(failed_ids))
+
+        if self.stopping.is_set():
+            self.bot.send_message(self.group_id, _("Broadcast cancelled"))
+        else:
+            self.bot.send_message(self.group_id, _("Broadcast message sent successfully."))
+
+    # copyMessage reuses the stored message server-side, whatever its type, instead of re-sending its content
+    def send_broadcast(self, user_id: int, source_id: int):
+        call_with_retry(self.bot.copy_message, user_id, self.group_id, source_id, limiter=self.broadcast_limiter)
+
+    def cancel_broadcast_message(self, message: Message):
+        self.bot.delete_message(self.group_id, message.message_id)
+        self.bot.send_message(self.group_id, _("Broadcast cancelled"))
+        self.cache.delete("broadcast_message_id")
+
+    def handle_verify(self, message: Message):
+        if message.chat.id != self.group_id or message.message_thread_id is None:
+            return
+
+        command_parts = message.text.split()
+        if len(command_parts) != 2 or (verified_status := VERIFY_ARGUMENTS.get(command_parts[1].lower())) is None:
+            self.bot.send_message(message.chat.id, _("Invalid command format.\nUse /verify <true/false>"),
+                                  message_thread_id=message.message_thread_id)
+            return
+
+        if (user_id := self.database.get_user_id(message.message_thread_id)) is not None:
+            self.database.set_verified(user_id, verified_status)
+        if user_id is None:
+            self.bot.send_message(message.chat.id, _("User not found"), message_thread_id=message.message_thread_id)
+        elif verified_status:
+            self.bot.send_message(message.chat.id, _("User verified successfully."),
+                                  message_thread_id=message.message_thread_id)
+            self.cache.set(f"verified_{user_id}", True, 1800)
+        else:
+            self.bot.send_message(message.chat.id, _("User verification removed."),
+                                  message_thread_id=message.message_thread_id)
+            self.cache.delete(f"verified_{user_id}")
+
+    def handle_reaction(self, message: MessageReactionUpdated):
+        if message.chat.id == self.group_id and message.chat.is_forum:
+            return
+        in_group = not (message.chat.id == self.group_id)
+        result = self.database.find_by_forwarded(message.message_id, in_group)
+        if result is None:
+            result = self.database.find_by_received(message.message_id, not in_group)
+        if result is None:
+            return
+        topic_id, forwarded_id = result
+        if in_group:
+            self.bot.set_message_reaction(chat_id=self.group_id, message_id=forwarded_id,
+                                          reaction=[message.new_reaction[-1]] if message.new_reaction else [])
+        else:
+            user_id = self.database.get_user_id(topic_id)
+            self.bot.set_message_reaction(chat_id=user_id, message_id=forwarded_id,
+                                          reaction=[message.new_reaction[-1]] if message.new_reaction else [])
+
+
+if __name__ == "__main__":
+    if not args.token or not args.group_id:
+        logger.error(_("Token or group ID is empty"))
+        exit(1)
+    try:
+        bot = TGBot(args.token, args.group_id, num_workers=args.workers)
+    except KeyboardInterrupt:
+        logger.info(_("Exiting..."))
+        exit(0)
+    except DatabaseUpgradeError as e:
+        logger.error(e)
+        print_exc()
+        exit(1)